@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fees import policy_arrays, route_amounts, substracted_amounts
+from journal import DrainJournal
+from liquidity import LiquidityStore
 from pyln.client import Plugin, Millisatoshi, RpcError
+import contextlib
+import os
 import re
+import threading
 import time
 import uuid
 
@@ -16,78 +24,68 @@ HTLC_FEE_MIN = Millisatoshi('100sat')
 HTLC_FEE_MAX = Millisatoshi('100000sat')
 HTLC_FEE_PAT = re.compile("^.* HTLC fee: ([0-9]+sat).*$")
 
+# BOLT #3 weights of a commitment transaction and of each HTLC output on it
+COMMITMENT_WEIGHT = 724
+COMMITMENT_WEIGHT_ANCHORS = 1124
+HTLC_WEIGHT = 172
 
-def setup_routing_fees(plugin, payload, route, amount, substractfees: bool=False):
-    delay = int(plugin.get_option('cltv-final'))
-
-    amount_iter = amount
-    for r in reversed(route):
-        r['msatoshi'] = amount_iter.millisatoshis
-        r['amount_msat'] = amount_iter
-        r['delay'] = delay
-        channels = plugin.rpc.listchannels(r['channel'])
-        ch = next(c for c in channels.get('channels') if c['destination'] == r['id'])
-        fee = Millisatoshi(ch['base_fee_millisatoshi'])
-        # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
-        fee += (amount_iter * ch['fee_per_millionth'] + 10**6 - 1) // 10**6    # integer math trick to round up
-        amount_iter += fee
-        delay += ch['delay']
+# maximum number of chunks when auto-detecting
+MAX_CHUNKS = 16
 
-    # amounts have to be calculated the other way when being fee substracted
-    # we took the upper loop as well for the delay parameter
-    if substractfees:
-        amount_iter = amount
-        first = True
-        for r in route:
+
+def setup_routing_fees(plugin, payload, route, amount, substractfees: bool=False):
+    # the policies are kept for the whole job, chunks mostly use the same channels,
+    # concurrent chunks may drop them meanwhile, so this route uses its own copy
+    policies = {}
+    for r in route:
+        policy = payload['policies'].get((r['channel'], r['id']))
+        if policy is None:
             channels = plugin.rpc.listchannels(r['channel'])
             ch = next(c for c in channels.get('channels') if c['destination'] == r['id'])
-            if not first:
-                fee = Millisatoshi(ch['base_fee_millisatoshi'])
-                # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
-                fee += (amount_iter * ch['fee_per_millionth'] + 10**6 - 1) // 10**6    # integer math trick to round up
-                if fee > amount_iter:
-                    raise RpcError(payload['command'], payload, {'message': 'cannot cover fees to %s %s' % (payload['command'], amount)})
-                amount_iter -= fee
-            first = False
-            r['msatoshi'] = amount_iter.millisatoshis
-            r['amount_msat'] = amount_iter
+            policy = {'base': ch['base_fee_millisatoshi'], 'ppm': ch['fee_per_millionth'], 'delay': ch['delay']}
+            payload['policies'][r['channel'], r['id']] = policy
+        policies[r['channel'], r['id']] = policy
+    base, ppm, delay = policy_arrays([route], lambda r: policies[r['channel'], r['id']])
+    amounts, delays = route_amounts(base, ppm, delay, int(amount), int(plugin.get_option('cltv-final')))
 
+    # amounts have to be calculated the other way when being fee substracted
+    # we took the upper calculation as well for the delay parameter
+    if substractfees:
+        amounts, ok = substracted_amounts(base, ppm, int(amount))
+        if not ok[0]:
+            raise RpcError(payload['command'], payload, {'message': 'cannot cover fees to %s %s' % (payload['command'], amount)})
 
-# This raises an error when a channel is not normal or peer is not connected
-def get_channel(plugin, payload, peer_id, scid):
-    peer = plugin.rpc.listpeers(peer_id).get('peers')[0]
-    channel = next(c for c in peer['channels'] if 'short_channel_id' in c and c['short_channel_id'] == scid)
-    if channel['state'] != "CHANNELD_NORMAL":
-        raise RpcError(payload['command'], payload, {'message': 'Channel %s not in state CHANNELD_NORMAL, but: %s' % (scid, channel['state']) })
-    if not peer['connected']:
-        raise RpcError(payload['command'], payload, {'message': 'Channel %s peer is not connected.' % scid})
-    return channel
+    for i, r in enumerate(route):
+        r['msatoshi'] = int(amounts[0, i])
+        r['amount_msat'] = Millisatoshi(r['msatoshi'])
+        r['delay'] = int(delays[0, i])
 
 
-def spendable_from_scid(plugin, payload, scid=None):
-    if scid is None:
-        scid = payload['scid']
+def commitment_htlc_fee(channel):
+    """The commitment fee the opener pays for adding one more HTLC.
 
-    # only fetch funds once to reduce RPC load
-    if not "funds" in payload:
-        payload['funds'] = plugin.rpc.listfunds().get('channels')
+    This is the fee of the whole commitment transaction with that HTLC,
+    as `spendable_msat` does not account for it. Returns `None` when the
+    channel does not tell its feerate.
+    """
+    if channel.get('opener', 'local') != 'local':
+        return Millisatoshi(0)
+    feerate = channel.get('feerate', {}).get('perkw')
+    if feerate is None:
+        return None
+    weight = COMMITMENT_WEIGHT
+    if 'option_anchor_outputs' in channel.get('features', []):
+        weight = COMMITMENT_WEIGHT_ANCHORS
+    weight += HTLC_WEIGHT * (len(channel.get('htlcs', [])) + 1)
+    return Millisatoshi(int(feerate) * weight // 1000 * 1000)
 
-    try:
-        channel_funds = next(c for c in payload['funds'] if 'short_channel_id' in c and c['short_channel_id'] == scid)
-    except StopIteration:
-        return Millisatoshi(0), Millisatoshi(0)
-    peer_id = channel_funds['peer_id']
-    funds_our = Millisatoshi(channel_funds['our_amount_msat'])
-    try:
-        channel_peer = get_channel(plugin, payload, peer_id, scid)
-    except RpcError:
-        return Millisatoshi(0), Millisatoshi(0)
 
+def channel_state(peer, channel):
     # we check amounts via gossip and not wallet funds, as its more accurate
-    our = Millisatoshi(channel_peer['to_us_msat'])
-    total = Millisatoshi(channel_peer['total_msat'])
-    our_reserve = Millisatoshi(channel_peer['our_reserve_msat'])
-    their_reserve = Millisatoshi(channel_peer['their_reserve_msat'])
+    our = Millisatoshi(channel['to_us_msat'])
+    total = Millisatoshi(channel['total_msat'])
+    our_reserve = Millisatoshi(channel['our_reserve_msat'])
+    their_reserve = Millisatoshi(channel['their_reserve_msat'])
     their = total - our
 
     # reserves maybe not filled up yet
@@ -96,17 +94,61 @@ def spendable_from_scid(plugin, payload, scid=None):
     if their < their_reserve:
         their_reserve = their
 
-    spendable = channel_peer['spendable_msat']
-    receivable = their - their_reserve
-    return spendable, receivable
+    return {
+        'peer_id': peer['id'],
+        'connected': peer['connected'],
+        'state': channel['state'],
+        'spendable': Millisatoshi(channel['spendable_msat']),
+        'receivable': their - their_reserve,
+        'htlc_fee': commitment_htlc_fee(channel),
+    }
+
+
+def get_snapshot(plugin, payload, peer_id=None):
+    """Index the state of our channels by scid from a single `listpeers` call.
+
+    With `peer_id` only the channels of that peer are fetched again. The
+    snapshot is replaced, never changed, so concurrent chunks can read it.
+    """
+    snapshot = dict(payload.get('snapshot', {})) if peer_id is not None else {}
+    for peer in plugin.rpc.listpeers(peer_id).get('peers'):
+        for channel in peer['channels']:
+            if 'short_channel_id' in channel:
+                snapshot[channel['short_channel_id']] = channel_state(peer, channel)
+    payload['snapshot'] = snapshot
+    return snapshot
+
+
+# This raises an error when a channel is not normal or peer is not connected
+def get_channel(plugin, payload, scid, refresh: bool=False):
+    if refresh or 'snapshot' not in payload:
+        peer_id = payload.get('snapshot', {}).get(scid, {}).get('peer_id')
+        get_snapshot(plugin, payload, peer_id)
+    channel = payload['snapshot'].get(scid)
+    if channel is None:
+        raise RpcError(payload['command'], payload, {'message': 'Cannot find channel: ' + scid})
+    if channel['state'] != "CHANNELD_NORMAL":
+        raise RpcError(payload['command'], payload, {'message': 'Channel %s not in state CHANNELD_NORMAL, but: %s' % (scid, channel['state']) })
+    if not channel['connected']:
+        raise RpcError(payload['command'], payload, {'message': 'Channel %s peer is not connected.' % scid})
+    return channel
 
 
-def peer_from_scid(plugin, payload, short_channel_id, my_id):
-    channels = plugin.rpc.listchannels(short_channel_id).get('channels')
+def spendable_from_scid(plugin, payload, scid=None, refresh: bool=False):
+    if scid is None:
+        scid = payload['scid']
     try:
-        return next(c for c in channels if c['source'] == my_id)['destination']
-    except StopIteration:
+        channel = get_channel(plugin, payload, scid, refresh)
+    except RpcError:
+        return Millisatoshi(0), Millisatoshi(0)
+    return channel['spendable'], channel['receivable']
+
+
+def peer_from_scid(plugin, payload, short_channel_id):
+    channel = get_snapshot(plugin, payload).get(short_channel_id)
+    if channel is None:
         raise RpcError(payload['command'], payload, {'message': 'Cannot find peer for channel: ' + short_channel_id})
+    return channel['peer_id']
 
 
 def find_worst_channel(route):
@@ -123,6 +165,54 @@ def find_worst_channel(route):
     return worst
 
 
+def assign_chunks(amount, capacities, costs, chunks=0):
+    """Split `amount` into chunks, each assigned to one of our counter channels.
+
+    `capacities` maps a channel to the amount it can take, `costs` to the
+    `(base, ppm)` fee of forwarding a chunk over it. Channels are filled
+    cheapest first, one chunk each. If that needs more than `chunks` (or 16)
+    chunks, the biggest channels are filled first instead. With a fixed number
+    of `chunks` the biggest chunks are split until there are that many.
+    Returns a list of `(amount, scid)`, biggest first, or `None` if the amount
+    does not fit.
+    """
+    amount = int(amount)
+    if amount <= 0:
+        return None
+    usable = [scid for scid in capacities if capacities[scid] > 0]
+
+    def rate(scid):
+        base, ppm = costs.get(scid, (0, 0))
+        # fee per million msat of the chunk this channel would take
+        return ppm + base * 10**6 // min(capacities[scid], amount)
+
+    def fill(order):
+        plan, remaining = [], amount
+        for scid in order:
+            if remaining <= 0:
+                break
+            size = min(capacities[scid], remaining)
+            plan.append((size, scid))
+            remaining -= size
+        return plan if remaining <= 0 else None
+
+    limit = chunks if chunks >= 1 else MAX_CHUNKS
+    plan = fill(sorted(usable, key=lambda s: (rate(s), -capacities[s])))
+    if plan is not None and len(plan) > limit:
+        plan = fill(sorted(usable, key=lambda s: (-capacities[s], rate(s))))
+    if plan is None or len(plan) > limit:
+        return None
+    while len(plan) < chunks:
+        plan.sort(reverse=True)
+        size, scid = plan[0]
+        if size < 2:
+            return None
+        plan[0] = (size - size // 2, scid)
+        plan.append((size // 2, scid))
+    plan.sort(reverse=True)
+    return [(Millisatoshi(size), scid) for size, scid in plan]
+
+
 def test_or_set_chunks(plugin, payload, my_id):
     scid = payload['scid']
     cmd = payload['command']
@@ -137,69 +227,80 @@ def test_or_set_chunks(plugin, payload, my_id):
         amount = receivable
 
     # get all spendable/receivables for our channels
-    channels = {}
-    for channel in plugin.rpc.listchannels(source=my_id).get('channels'):
-        if channel['short_channel_id'] == scid:
+    capacities = {}
+    for other in payload['snapshot']:
+        if other == scid:
             continue
-        spend, recv = spendable_from_scid(plugin, payload, channel['short_channel_id'])
-        channels[channel['short_channel_id']] = {
-            'spendable' : spend,
-            'receivable' : recv,
-        }
+        spend, recv = spendable_from_scid(plugin, payload, other)
+        if cmd == "drain":
+            capacities[other] = int(recv)
+        if cmd == "fill":
+            # the counter channel also has to send the fees
+            capacities[other] = int(int(spend) * 100 / (100 + payload['maxfeepercent']))
+
+    # what the peers charge to forward a drained chunk back to us,
+    # all their policies towards us come with a single call
+    costs = {}
+    if cmd == "drain":
+        try:
+            policies = plugin.rpc.listchannels(destination=my_id).get('channels')
+        except RpcError:
+            # older lightningd versions cannot filter by destination
+            policies = [c for other in capacities if capacities[other] > 0
+                        for c in plugin.rpc.listchannels(other).get('channels')]
+        for ch in policies:
+            other = ch['short_channel_id']
+            if capacities.get(other, 0) > 0 and ch['source'] == payload['snapshot'][other]['peer_id']:
+                costs[other] = (int(ch['base_fee_millisatoshi']), int(ch['fee_per_millionth']))
+
+    plan = assign_chunks(amount, capacities, costs, payload['chunks'])
+    if plan is not None:
+        payload['chunks'] = len(plan)
+        payload['plan'] = plan
+        return
 
     # test if selected chunks fit into other channel capacities
     if payload['chunks'] >= 1:
         chunks = payload['chunks']
-        chunksize = amount / chunks
-        fit = 0
-        for i in channels:
-            channel = channels[i]
-            if cmd == "drain":
-                fit += int(channel['receivable']) // int(chunksize)
-            if cmd == "fill":
-                fit += int(channel['spendable']) // int(chunksize)
-        if fit >= chunks:
-            return
         if cmd == "drain":
             raise RpcError(payload['command'], payload, {'message': 'Selected chunks (%d) will not fit incoming channel capacities.' % chunks})
         if cmd == "fill":
             raise RpcError(payload['command'], payload, {'message': 'Selected chunks (%d) will not fit outgoing channel capacities.' % chunks})
 
-
-    # if chunks is 0 -> auto detect from 1 to 16 (max) chunks until amounts fit
-    else:
-        chunks = 0
-        while chunks < 16:
-            chunks += 1
-            chunksize = amount / chunks
-            fit = 0
-            for i in channels:
-                channel = channels[i]
-                if cmd == "drain" and int(channel['receivable']) > 0:
-                    fit += int(channel['receivable']) // int(chunksize)
-                if cmd == "fill" and int(channel['spendable']) > 0:
-                    fit += int(channel['spendable']) // int(chunksize)
-                if fit >= chunks:
-                    payload['chunks'] = chunks
-                    return
-
-        if cmd == "drain":
-            raise RpcError(payload['command'], payload, {'message': 'Cannot detect required chunks to perform operation. Incoming capacity problem.'})
-        if cmd == "fill":
-            raise RpcError(payload['command'], payload, {'message': 'Cannot detect required chunks to perform operation. Outgoing capacity problem.'})
+    # if chunks is 0 -> auto detect up to 16 (max) chunks
+    if cmd == "drain":
+        raise RpcError(payload['command'], payload, {'message': 'Cannot detect required chunks to perform operation. Incoming capacity problem.'})
+    if cmd == "fill":
+        raise RpcError(payload['command'], payload, {'message': 'Cannot detect required chunks to perform operation. Outgoing capacity problem.'})
 
 
 def cleanup(plugin, payload, error=None):
-    # delete all invoices and count how many went through
-    successful_chunks = 0
-    for label in payload['labels']:
+    # chunks are known to be paid when waitsendpay said so, the others
+    # may have been paid after waitsendpay timed out, so ask lightningd
+    labels = set(payload['labels'])
+    paid = set(payload['paid'])
+    status = {}
+    if labels - paid:
+        try:
+            invoices = plugin.rpc.listinvoices().get('invoices')
+            status = dict((i['label'], i['status']) for i in invoices if i['label'] in labels)
+            paid |= set(label for label in status if status[label] == 'paid')
+        except RpcError as e:
+            plugin.log("Cannot list invoices: %s" % e)
+
+    # delete all invoices of failed attempts in one pass
+    for label in labels - paid:
         try:
-            plugin.rpc.delinvoice(label, 'unpaid')
+            plugin.rpc.delinvoice(label, status.get(label, 'unpaid'))
         except RpcError as e:
-            # race condition: waitsendpay timed out, but invoice got paid
-            if 'status is paid' in e.error.get('message', ""):
-                successful_chunks += 1
+            plugin.log("Cannot delete invoice %s: %s" % (label, e))
 
+    successful_chunks = len(paid)
+    if 'job_id' in payload:
+        if successful_chunks == payload['chunks']:
+            plugin.journal.finish(payload['job_id'], 'done')
+        else:
+            plugin.journal.finish(payload['job_id'], 'partial' if successful_chunks > 0 else 'failed')
     if successful_chunks == payload['chunks']:
         return payload['success_msg']
     if successful_chunks > 0:
@@ -210,48 +311,189 @@ def cleanup(plugin, payload, error=None):
     raise error
 
 
-def try_for_htlc_fee(plugin, payload, my_id, peer_id, amount, chunk, spendable_before):
-    start_ts = int(time.time())
-    label = payload['command'] + "-" + str(uuid.uuid4())
-    payload['labels'] += [label]
-    description = "%s %s %s%s [%d/%d]" % (payload['command'], payload['scid'], payload['percentage'], '%', chunk+1, payload['chunks'])
-    invoice = plugin.rpc.invoice("any", label, description, payload['retry_for'] + 60)
-    payment_hash = invoice['payment_hash']
-    plugin.log("Invoice payment_hash: %s" % payment_hash)
+def busy_lock(busy):
+    """The lock concurrent chunks hold while they use `payload['routes']` and
+    `payload['policies']`, no lock is needed for a single chunk."""
+    return busy['lock'] if busy is not None else contextlib.nullcontext()
+
+
+def busy_excludes(busy):
+    """Excludes for the channels of chunks in flight."""
+    if busy is None:
+        return []
+    with busy['lock']:
+        return [c + '/' + d for c in busy['channels'] for d in '01']
+
+
+def claim_busy(busy, channel, counter):
+    """Mark `channel` as used by one more chunk in flight.
 
+    Chunks assigned the same `counter` share it, a channel that another
+    chunk claimed while this one searched its route is refused otherwise.
+    """
+    if busy is None:
+        return True
+    with busy['lock']:
+        if counter is None and busy['channels'][channel] > 0:
+            return False
+        busy['channels'][channel] += 1
+        return True
+
+
+def release_busy(busy, channel):
+    if busy is not None:
+        with busy['lock']:
+            busy['channels'][channel] -= 1
+            if busy['channels'][channel] <= 0:
+                del busy['channels'][channel]
+
+
+def chunk_excludes(plugin, payload, amount, refresh: bool=True):
     # exclude selected channel to prevent unwanted shortcuts
     excludes = [payload['scid']+'/0', payload['scid']+'/1']
-    mychannels = plugin.rpc.listchannels(source=my_id).get('channels')
     # exclude local channels known to have too little capacity.
     # getroute currently does not do this.
-    for channel in mychannels:
-        if channel['short_channel_id'] == payload['scid']:
+    # other chunks may have changed them, so take a fresh snapshot
+    snapshot = get_snapshot(plugin, payload) if refresh else payload['snapshot']
+    for channel in snapshot:
+        if channel == payload['scid']:
             continue  # already added few lines above
-        spend, recv = spendable_from_scid(plugin, payload, channel['short_channel_id'])
+        spend, recv = spendable_from_scid(plugin, payload, channel)
         if payload['command'] == 'drain' and recv < amount:
-            excludes += [channel['short_channel_id']+'/0', channel['short_channel_id']+'/1']
+            excludes += [channel+'/0', channel+'/1']
         if payload['command'] == 'fill' and spend < amount:
-            excludes += [channel['short_channel_id']+'/0', channel['short_channel_id']+'/1']
+            excludes += [channel+'/0', channel+'/1']
+    # skip channels that recently failed or lack liquidity for this amount
+    excludes += plugin.liquidity.excludes(amount)
+    return excludes
 
-    while int(time.time()) - start_ts < payload['retry_for']:
-        if payload['command'] == 'drain':
+
+def fees_too_high(payload, amount, fees):
+    # NOTE: the int(msat) casts are just a workaround for outdated pylightning versions
+    return fees > payload['exemptfee'] and int(fees) > int(amount) * payload['maxfeepercent'] / 100
+
+
+def cached_route(payload, excludes, counter=None):
+    """The last route that delivered a chunk over `counter`, or over any
+    counter channel if `None`, and that does not use an excluded channel."""
+    if counter is not None:
+        candidates = [payload['routes'].get(counter)]
+    else:
+        candidates = reversed(list(payload['routes'].values()))
+    excluded = set(e.split('/')[0] for e in excludes)
+    for route in candidates:
+        if route is not None and not any(r['channel'] in excluded for r in route if r['channel'] != payload['scid']):
+            return [dict(r) for r in route]
+    return None
+
+
+def cache_route(payload, route, counter_channel, success: bool=True):
+    """Remember the hops of a route that delivered a chunk, or forget them when it failed.
+
+    Concurrent chunks share `payload['routes']`, call this under `busy_lock`.
+    """
+    hops = [{'id': r['id'], 'channel': r['channel'], 'direction': r['direction']} for r in route]
+    if success:
+        payload['routes'].pop(counter_channel, None)  # most recent last
+        payload['routes'][counter_channel] = hops
+    elif payload['routes'].get(counter_channel) == hops:
+        payload['routes'].pop(counter_channel, None)
+
+
+def find_chunk_route(plugin, payload, my_id, peer_id, amount, chunk, excludes, counter=None, busy=None):
+    """Route of a chunk with amounts and delays set, over `counter` if possible.
+
+    A route that delivered an earlier chunk of the job is used again with the
+    amounts of this chunk, before `getroute` is asked for a new one.
+    Returns the route and the counter channel, which is `None` when no route
+    over it was found. Raises the RpcError of `getroute` if there is no route.
+    """
+    with busy_lock(busy):
+        route = cached_route(payload, excludes, counter)
+    if route is not None:
+        setup_routing_fees(plugin, payload, route, amount, payload['command'] == 'drain')
+        return route, counter
+    if counter is not None:
+        # force the counter channel as last (drain) or first (fill)
+        # hop and search the route in between without our channels
+        counter_peer = payload['snapshot'][counter]['peer_id']
+        forced_excludes = excludes + [c + '/' + d for c in payload['snapshot'] for d in '01']
+        try:
+            if counter_peer == peer_id:
+                middle = []
+            elif payload['command'] == 'drain':
+                middle = plugin.rpc.getroute(counter_peer, amount, riskfactor=0,
+                        cltv=9, fromid=peer_id, fuzzpercent=0, exclude=forced_excludes)['route']
+            else:
+                middle = plugin.rpc.getroute(peer_id, amount, riskfactor=0,
+                        cltv=9, fromid=counter_peer, fuzzpercent=0, exclude=forced_excludes)['route']
+        except RpcError as e:
+            plugin.log("[%d/%d] No route over %s, trying other channels: %s" % (chunk+1, payload['chunks'], counter, e))
+            counter = None
+    if payload['command'] == 'drain':
+        route_out = {'id': peer_id, 'channel': payload['scid'], 'direction': int(my_id >= peer_id)}
+        if counter is not None:
+            route = [route_out] + middle + [{'id': my_id, 'channel': counter, 'direction': int(counter_peer >= my_id)}]
+        else:
             r = plugin.rpc.getroute(my_id, amount, riskfactor=0,
                     cltv=9, fromid=peer_id, fuzzpercent=0, exclude=excludes)
-            route_out = {'id': peer_id, 'channel': payload['scid'], 'direction': int(my_id >= peer_id)}
             route = [route_out] + r['route']
-            setup_routing_fees(plugin, payload, route, amount, True)
-        if payload['command'] == 'fill':
+        setup_routing_fees(plugin, payload, route, amount, True)
+    if payload['command'] == 'fill':
+        route_in = {'id': my_id, 'channel': payload['scid'], 'direction': int(peer_id >= my_id)}
+        if counter is not None:
+            route = [{'id': counter_peer, 'channel': counter, 'direction': int(my_id >= counter_peer)}] + middle + [route_in]
+        else:
             r = plugin.rpc.getroute(peer_id, amount, riskfactor=0,
                     cltv=9, fromid=my_id, fuzzpercent=0, exclude=excludes)
-            route_in = {'id': my_id, 'channel': payload['scid'], 'direction': int(peer_id >= my_id)}
             route = r['route'] + [route_in]
-            setup_routing_fees(plugin, payload, route, amount , False)
+        setup_routing_fees(plugin, payload, route, amount , False)
+    return route, counter
+
+
+def chunk_invoice(plugin, payload, chunk):
+    """The invoice of a chunk, all attempts to send the chunk pay the same one."""
+    if chunk not in payload['invoices']:
+        label = payload['command'] + "-" + str(uuid.uuid4())
+        description = "%s %s %s%s [%d/%d]" % (payload['command'], payload['scid'], payload['percentage'], '%', chunk+1, payload['chunks'])
+        invoice = plugin.rpc.invoice("any", label, description, payload['retry_for'] + 60)
+        plugin.log("Invoice payment_hash: %s" % invoice['payment_hash'])
+        payload['labels'] += [label]
+        payload['invoices'][chunk] = (label, invoice)
+        if 'job_id' in payload:
+            plugin.journal.invoice(payload['job_id'], chunk, label, invoice['payment_hash'])
+    return payload['invoices'][chunk]
+
+
+def try_for_htlc_fee(plugin, payload, my_id, peer_id, amount, chunk, spendable_before, busy=None, counter=None):
+    """Send one chunk, retrying over other routes until `retry_for` is over.
+
+    The chunk comes back (drain) or leaves (fill) over our `counter` channel,
+    if one was assigned. When no route over it is found or it fails, any
+    other channel is used. Concurrent chunks share the `busy` dict counting
+    the chunks in flight over each of our channels, which are excluded so
+    every chunk takes another one, unless they were assigned the same one. Without `spendable_before` the chunk does not wait for
+    gossip to reflect it.
+    """
+    start_ts = payload.get('start_ts', int(time.time()))
+    label, invoice = chunk_invoice(plugin, payload, chunk)
+    payment_hash = invoice['payment_hash']
+
+    excludes = chunk_excludes(plugin, payload, amount)
+
+    while int(time.time()) - start_ts < payload['retry_for']:
+        # the route search runs unlocked, so chunks search at the same time
+        route, counter = find_chunk_route(plugin, payload, my_id, peer_id, amount, chunk,
+                                          excludes + busy_excludes(busy), counter, busy)
+        counter_channel = route[-1]['channel'] if payload['command'] == 'drain' else route[0]['channel']
+        if not claim_busy(busy, counter_channel, counter):
+            continue  # taken by another chunk meanwhile, the next search excludes it
 
         fees = route[0]['amount_msat'] - route[-1]['amount_msat']
 
         # check fee and exclude worst channel the next time
-        # NOTE: the int(msat) casts are just a workaround for outdated pylightning versions
-        if fees > payload['exemptfee'] and int(fees) > int(amount) * payload['maxfeepercent'] / 100:
+        if fees_too_high(payload, amount, fees):
+            release_busy(busy, counter_channel)
             worst_channel_id = find_worst_channel(route)
             if worst_channel_id is None:
                 raise RpcError(payload['command'], payload, {'message': 'Insufficient fee'})
@@ -263,16 +505,25 @@ def try_for_htlc_fee(plugin, payload, my_id, peer_id, amount, chunk, spendable_b
             plugin.log("    - %s  %14s  %s" % (r['id'], r['channel'], r['amount_msat']))
 
         try:
+            if 'job_id' in payload:
+                plugin.journal.sent(payload['job_id'], chunk)
             plugin.rpc.sendpay(route, payment_hash, label)
             result = plugin.rpc.waitsendpay(payment_hash, payload['retry_for'] + start_ts - int(time.time()))
             if result.get('status') == 'complete':
+                payload['paid'] += [label]
+                with busy_lock(busy):
+                    cache_route(payload, route, counter_channel)
+                if 'job_id' in payload:
+                    plugin.journal.paid(payload['job_id'], chunk)
+                plugin.liquidity.record_success(route[1:-1])
                 payload['success_msg'] += ["%dmsat sent over %d hops to %s %dmsat [%d/%d]" % (amount + fees, len(route), payload['command'], amount, chunk+1, payload['chunks'])]
                 # we need to wait for gossipd to update to new state,
                 # so remaining amounts will be calculated correctly for the next chunk
-                spendable, _ = spendable_from_scid(plugin, payload)
-                while spendable == spendable_before:
-                    time.sleep(0.5)
-                    spendable, _ = spendable_from_scid(plugin, payload)
+                if spendable_before is not None:
+                    spendable, _ = spendable_from_scid(plugin, payload, refresh=True)
+                    while spendable == spendable_before:
+                        time.sleep(0.5)
+                        spendable, _ = spendable_from_scid(plugin, payload, refresh=True)
                 return True
             return False
 
@@ -291,14 +542,27 @@ def try_for_htlc_fee(plugin, payload, my_id, peer_id, amount, chunk, spendable_b
 
             if erring_channel == payload['scid']:
                 raise RpcError(payload['command'], payload, {'message': 'Error with selected channel: %s' % erring_message})
+            if erring_channel == counter:
+                counter = None
+            with busy_lock(busy):
+                cache_route(payload, route, counter_channel, False)
+                # the erring channel may have sent a new policy along with the error
+                for key in [k for k in payload['policies'] if k[0] == erring_channel]:
+                    payload['policies'].pop(key, None)
 
             plugin.log("RpcError: " + str(e))
             if erring_channel is not None and erring_direction is not None:
                 excludes.append(erring_channel + '/' + str(erring_direction))
+                # remember the failure for later runs and the other plugins
+                hop = next((h for h in route[1:-1] if h['channel'] == erring_channel), None)
+                if hop is not None:
+                    plugin.liquidity.record_failure(excludes[-1], hop['msatoshi'], e.error['data'].get('failcode'))
+        finally:
+            release_busy(busy, counter_channel)
 
 
 def read_params(command: str, scid: str, percentage: float,
-        chunks: int, maxfeepercent: float, retry_for: int, exemptfee: Millisatoshi):
+        chunks: int, maxfeepercent: float, retry_for: int, exemptfee: Millisatoshi, dryrun: bool=False):
 
     # check parameters
     if command != 'drain' and command != 'fill' and command != 'setbalance':
@@ -318,7 +582,12 @@ def read_params(command: str, scid: str, percentage: float,
         "maxfeepercent": maxfeepercent,
         "retry_for": retry_for,
         "exemptfee": exemptfee,
+        "dryrun": dryrun,
         "labels" : [],
+        "invoices" : {},
+        "paid" : [],
+        "routes" : {},
+        "policies" : {},
         "success_msg" : [],
     }
 
@@ -342,20 +611,152 @@ def read_params(command: str, scid: str, percentage: float,
     return payload
 
 
+def run_chunks(plugin, payload, my_id, peer_id, todo):
+    """Send chunks concurrently within a single `retry_for` window.
+
+    Up to `drain-parallel` chunks are in flight, each over another one of
+    our channels, as assigned by the `(chunk, amount, counter)` in `todo`. A chunk that fails while others are
+    in flight is sent again over any channel once one of them is done and
+    its channel is free again. Returns
+    the first error or `None` if all chunks went through.
+    """
+    busy = {'lock': threading.Lock(), 'channels': Counter()}
+    payload['start_ts'] = int(time.time())
+    todo = list(todo)
+    waiting = []
+    inflight = {}
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers=int(plugin.get_option('drain-parallel'))) as executor:
+            while todo or inflight:
+                while todo and error is None and int(time.time()) - payload['start_ts'] < payload['retry_for']:
+                    chunk, amount, counter = todo.pop(0)
+                    future = executor.submit(try_for_htlc_fee, plugin, payload, my_id, peer_id, amount, chunk, None, busy, counter)
+                    inflight[future] = (chunk, amount, counter)
+                if not inflight:
+                    break
+                done = next(as_completed(inflight))
+                chunk, amount, counter = inflight.pop(done)
+                # a chunk has finished, so the ones that had to wait get another chance
+                todo += waiting
+                waiting = []
+                try:
+                    if done.result():
+                        continue
+                    failure = RpcError(payload['command'], payload, {'message': 'Chunk %d failed' % (chunk + 1)})
+                except RpcError as e:
+                    if e.error.get('message', '').startswith('Error with selected channel'):
+                        error = error or e
+                        continue
+                    failure = e
+                except ValueError as e:
+                    # the HTLCs of the other chunks take up the capacity of the selected channel
+                    failure = e
+                except Exception as e:
+                    error = error or e
+                    continue
+                if inflight:
+                    plugin.log("[%d/%d] Failed, retrying when another chunk is done: %s" % (chunk + 1, payload['chunks'], failure))
+                    waiting.append((chunk, amount, None))
+                else:
+                    error = error or failure
+            if (todo or waiting) and error is None:
+                error = RpcError(payload['command'], payload, {'message': 'Timeout while sending chunks'})
+    finally:
+        del payload['start_ts']
+    return error
+
+
+def dry_run(plugin, payload, my_id, peer_id):
+    """Plan every chunk with its route and fees without sending anything."""
+    spendable, receivable = spendable_from_scid(plugin, payload)
+    htlc_fee = payload['snapshot'][payload['scid']]['htlc_fee'] or HTLC_FEE_NUL
+    chunks = []
+    planned = Millisatoshi(0)
+    for chunk, (amount, counter) in enumerate(payload['plan']):
+        # the last chunk has to leave the HTLC commitment fee in the channel
+        if chunk == payload['chunks'] - 1 and payload['command'] == 'drain' and spendable - planned - amount <= htlc_fee:
+            amount -= htlc_fee
+        planned += amount
+        result = {"chunk": chunk + 1, "amount_msat": amount}
+        try:
+            excludes = chunk_excludes(plugin, payload, amount, False)
+            while True:
+                route, counter = find_chunk_route(plugin, payload, my_id, peer_id, amount, chunk, excludes, counter)
+                fees = route[0]['amount_msat'] - route[-1]['amount_msat']
+                if not fees_too_high(payload, amount, fees):
+                    break
+                worst_channel_id = find_worst_channel(route)
+                if worst_channel_id is None:
+                    raise RpcError(payload['command'], payload, {'message': 'Insufficient fee'})
+                excludes += [worst_channel_id + '/0', worst_channel_id + '/1']
+            result.update({
+                "counter_scid": route[-1]['channel'] if payload['command'] == 'drain' else route[0]['channel'],
+                "fee_msat": fees,
+                "hops": len(route),
+                "route": [{"id": r['id'], "channel": r['channel'], "direction": r['direction'],
+                           "amount_msat": r['amount_msat'], "delay": r['delay']} for r in route],
+            })
+        except RpcError as e:
+            result["error"] = e.error.get('message', str(e))
+        chunks.append(result)
+
+    routed = [c for c in chunks if 'error' not in c]
+    return {
+        "command": payload['command'],
+        "scid": payload['scid'],
+        "amount_msat": Millisatoshi(sum(int(c['amount_msat']) for c in routed)),
+        "fee_msat": Millisatoshi(sum(int(c['fee_msat']) for c in routed)),
+        "htlc_fee_msat": htlc_fee,
+        "complete": len(routed) == len(chunks),
+        "chunks": chunks,
+    }
+
+
+def paid_chunks(payload):
+    """The chunks whose invoice is known to be paid."""
+    return set(chunk for chunk, (label, _) in payload['invoices'].items() if label in payload['paid'])
+
+
 def execute(payload: dict):
     my_id = plugin.rpc.getinfo().get('id')
-    peer_id = peer_from_scid(plugin, payload, payload['scid'], my_id)
-    get_channel(plugin, payload, peer_id, payload['scid']) # ensures or raises error
+    peer_id = peer_from_scid(plugin, payload, payload['scid'])
+    get_channel(plugin, payload, payload['scid']) # ensures or raises error
     test_or_set_chunks(plugin, payload, my_id)
     plugin.log("%s  %s  %d%%  %d chunks" % (payload['command'], payload['scid'], payload['percentage'], payload['chunks']))
-
-    # iterate of chunks, default just one
-    for chunk in range(payload['chunks']):
-        # we discover remaining capacities for each chunk,
+    if payload['dryrun']:
+        return dry_run(plugin, payload, my_id, peer_id)
+
+    # the plan goes to the journal before anything is paid,
+    # so a restart can pick the job up where it was interrupted
+    payload['job_id'] = str(uuid.uuid4())
+    plugin.journal.start(payload['job_id'], journal_params(payload), payload['plan'])
+    return run_job(plugin, payload, my_id, peer_id)
+
+
+def run_job(plugin, payload, my_id, peer_id):
+    """Send all planned chunks that are not paid yet."""
+    paid = paid_chunks(payload)
+
+    # all chunks but the last are sent at the same time, the last one
+    # has to find out the HTLC commitment fee when emptying a channel
+    todo = [(chunk, amount, counter) for chunk, (amount, counter) in enumerate(payload['plan'][:-1]) if chunk not in paid]
+    if todo:
+        error = run_chunks(plugin, payload, my_id, peer_id, todo)
+        if error is not None:
+            return cleanup(plugin, payload, error)
+
+    if payload['chunks'] - 1 in paid:
+        return cleanup(plugin, payload)
+
+    chunk = payload['chunks'] - 1
+    amount, counter = payload['plan'][-1]
+    result = False
+    # any error has to finalize the job, or it would be resumed after a restart
+    try:
+        # we discover remaining capacities for the last chunk,
         # as fees from previous chunks affect reserves
-        spendable, receivable = spendable_from_scid(plugin, payload)
-        total = spendable + receivable
-        amount = total * 0.01 * payload['percentage'] / payload['chunks']
+        spendable, receivable = spendable_from_scid(plugin, payload, refresh=True)
 
         # if capacity exceeds, limit amount to full or empty channel
         if payload['command'] == "drain" and amount > spendable:
@@ -363,89 +764,191 @@ def execute(payload: dict):
         if payload['command'] == "fill" and amount > receivable:
             amount = receivable
 
-        result = False
-        try:
-            # we need to try with different HTLC_FEE values
-            # until we dont get capacity error on first hop
+        # the HTLC commitment fee is calculated from the channel's feerate,
+        # if that is unknown or wrong we need to try with different HTLC_FEE
+        # values until we dont get capacity error on first hop
+        htlc_fee = payload['snapshot'][payload['scid']]['htlc_fee']
+        if htlc_fee is None:
             htlc_fee = HTLC_FEE_NUL
-            htlc_stp = HTLC_FEE_STP
+        htlc_stp = HTLC_FEE_STP
+        planned = amount
+
+        while htlc_fee < HTLC_FEE_MAX and result is False:
+            amount = planned
+            # When getting close to 100% we need to account for HTLC commitment fee
+            if payload['command'] == 'drain' and spendable - amount <= htlc_fee:
+                if amount < htlc_fee:
+                    raise RpcError(payload['command'], payload, {'message': 'channel too low to cover fees'})
+                amount -= htlc_fee
+            plugin.log("Trying... chunk:%s/%s  spendable:%s  receivable:%s  htlc_fee:%s =>  amount:%s" % (chunk+1, payload['chunks'], spendable, receivable, htlc_fee, amount))
+
+            try:
+                result = try_for_htlc_fee(plugin, payload, my_id, peer_id, amount, chunk, spendable, counter=counter)
+            except Exception as err:
+                if "htlc_fee is" in str(err) and Millisatoshi(str(err)[12:]) > htlc_fee:
+                    htlc_fee = Millisatoshi(str(err)[12:])
+                    plugin.log("Retrying with exact HTLC onchain fees: %s" % htlc_fee)
+                    continue
+                # unknown, or the one we tried was not enough
+                if "htlc_fee" in str(err):
+                    if htlc_fee < HTLC_FEE_MIN:
+                        htlc_fee = HTLC_FEE_MIN - HTLC_FEE_STP
+                    htlc_fee += htlc_stp
+                    htlc_stp *= 1.1  # exponential increase steps
+                    plugin.log("Retrying with additional HTLC onchain fees: %s" % htlc_fee)
+                    continue
+                raise err
+
+        # If result is still false, we tried allowed htlc_fee range unsuccessfully
+        if result is False:
+            raise RpcError(payload['command'], payload, {'message': 'Cannot determine required htlc commitment fees.'})
+
+    except Exception as e:
+        return cleanup(plugin, payload, e)
+
+    return cleanup(plugin, payload)
+
+
+def journal_params(payload):
+    """What the journal needs to know to resume a job."""
+    params = dict((k, payload[k]) for k in ('command', 'scid', 'percentage', 'chunks', 'maxfeepercent', 'retry_for'))
+    params['exemptfee'] = int(payload['exemptfee'])
+    return params
 
-            while htlc_fee < HTLC_FEE_MAX and result is False:
-                # When getting close to 100% we need to account for HTLC commitment fee
-                if payload['command'] == 'drain' and spendable - amount <= htlc_fee:
-                    if amount < htlc_fee:
-                        raise RpcError(payload['command'], payload, {'message': 'channel too low to cover fees'})
-                    amount -= htlc_fee
-                plugin.log("Trying... chunk:%s/%s  spendable:%s  receivable:%s  htlc_fee:%s =>  amount:%s" % (chunk+1, payload['chunks'], spendable, receivable, htlc_fee, amount))
 
+def resume_job(plugin, job):
+    """Finalize or continue a job that was interrupted by a restart.
+
+    Payments that were sent before the restart are waited for first, so a
+    chunk is never paid twice. Invoices of chunks that did not get paid are
+    deleted, if the job is resumed the chunks get new ones.
+    """
+    payload = dict(job['params'])
+    payload.update({
+        "exemptfee": Millisatoshi(payload['exemptfee']),
+        "dryrun": False,
+        "job_id": job['id'],
+        "plan": [(Millisatoshi(c['amount_msat']), c['counter_scid']) for c in job['chunks']],
+        "labels": [],
+        "invoices": {},
+        "paid": [],
+        "routes": {},
+        "policies": {},
+        "success_msg": [],
+    })
+    invoiced = [c for c in job['chunks'] if c['label'] is not None]
+    for c in invoiced:
+        if c['status'] == 'paid':
+            payload['labels'] += [c['label']]
+            payload['paid'] += [c['label']]
+            payload['invoices'][c['chunk']] = (c['label'], {'payment_hash': c['payment_hash']})
+            continue
+        if c['status'] == 'sent':
+            payments = plugin.rpc.listsendpays(payment_hash=c['payment_hash']).get('payments', [])
+            if any(p['status'] == 'pending' for p in payments):
+                plugin.log("[%d/%d] Waiting for payment %s sent before the restart" % (c['chunk']+1, payload['chunks'], c['payment_hash']))
                 try:
-                    result = try_for_htlc_fee(plugin, payload, my_id, peer_id, amount, chunk, spendable)
-                except Exception as err:
-                    if "htlc_fee unknown" in str(err):
-                        if htlc_fee == HTLC_FEE_NUL:
-                            htlc_fee = HTLC_FEE_MIN - HTLC_FEE_STP
-                        htlc_fee += htlc_stp
-                        htlc_stp *= 1.1  # exponential increase steps
-                        plugin.log("Retrying with additional HTLC onchain fees: %s" % htlc_fee)
-                        continue
-                    if "htlc_fee is" in str(err):
-                        htlc_fee = Millisatoshi(str(err)[12:])
-                        plugin.log("Retrying with exact HTLC onchain fees: %s" % htlc_fee)
-                        continue
-                    raise err
+                    plugin.rpc.waitsendpay(c['payment_hash'])
+                except RpcError as e:
+                    plugin.log("[%d/%d] Payment failed: %s" % (c['chunk']+1, payload['chunks'], e))
+
+    # lightningd knows best which invoices got paid in the meantime
+    if len(payload['paid']) < len(invoiced):
+        status = dict((i['label'], i['status']) for i in plugin.rpc.listinvoices().get('invoices'))
+        for c in invoiced:
+            if c['label'] in payload['paid']:
+                continue
+            if status.get(c['label']) == 'paid':
+                payload['labels'] += [c['label']]
+                payload['paid'] += [c['label']]
+                payload['invoices'][c['chunk']] = (c['label'], {'payment_hash': c['payment_hash']})
+                plugin.journal.paid(job['id'], c['chunk'])
+            elif c['label'] in status:
+                try:
+                    plugin.rpc.delinvoice(c['label'], status[c['label']])
+                except RpcError as e:
+                    plugin.log("Cannot delete invoice %s: %s" % (c['label'], e))
+
+    if len(payload['paid']) == payload['chunks'] or not plugin.resume:
+        return cleanup(plugin, payload, RpcError(payload['command'], payload, {'message': 'Interrupted by a restart'}))
+    plugin.log("Resuming %s  %s  %d/%d chunks paid, interrupted by a restart, set drain-resume=false to only finalize jobs"
+               % (payload['command'], payload['scid'], len(payload['paid']), payload['chunks']), 'warn')
+    try:
+        my_id = plugin.rpc.getinfo().get('id')
+        peer_id = peer_from_scid(plugin, payload, payload['scid'])
+        get_channel(plugin, payload, payload['scid'])
+    except RpcError as e:
+        return cleanup(plugin, payload, e)
+    return run_job(plugin, payload, my_id, peer_id)
 
-            # If result is still false, we tried allowed htlc_fee range unsuccessfully
-            if result is False:
-                raise RpcError(payload['command'], payload, {'message': 'Cannot determine required htlc commitment fees.'})
 
+def resume_jobs(plugin):
+    for job in plugin.journal.unfinished():
+        try:
+            result = resume_job(plugin, job)
+            plugin.log("Job %s finished: %s" % (job['id'], result))
         except Exception as e:
-            return cleanup(plugin, payload, e)
-
-    return cleanup(plugin, payload)
+            plugin.log("Job %s failed: %s" % (job['id'], e), 'warn')
 
 
 @plugin.method("drain")
 def drain(plugin, scid: str, percentage: float=100, chunks: int=0, maxfeepercent: float=0.5,
-        retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000)):
+        retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000), dryrun: bool=False):
     """Draining channel liquidity with circular payments.
 
     Percentage defaults to 100, resulting in an empty channel.
     Chunks defaults to 0 (auto-detect).
     Use 'drain 10' to decrease a channels total balance by 10%.
+    With 'dryrun' it only returns the planned chunks, routes and fees.
     """
-    payload = read_params('drain', scid, percentage, chunks, maxfeepercent, retry_for, exemptfee)
+    payload = read_params('drain', scid, percentage, chunks, maxfeepercent, retry_for, exemptfee, dryrun)
     return execute(payload)
 
 
 @plugin.method("fill")
 def fill(plugin, scid: str, percentage: float=100, chunks: int=0, maxfeepercent: float=0.5,
-        retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000)):
+        retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000), dryrun: bool=False):
     """Filling channel liquidity with circular payments.
 
     Percentage defaults to 100, resulting in a full channel.
     Chunks defaults to 0 (auto-detect).
     Use 'fill 10' to incease a channels total balance by 10%.
+    With 'dryrun' it only returns the planned chunks, routes and fees.
     """
-    payload = read_params('fill', scid, percentage, chunks, maxfeepercent, retry_for, exemptfee)
+    payload = read_params('fill', scid, percentage, chunks, maxfeepercent, retry_for, exemptfee, dryrun)
     return execute(payload)
 
 @plugin.method("setbalance")
 def setbalance(plugin, scid: str, percentage: float=50, chunks: int=0, maxfeepercent: float=0.5,
-        retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000)):
+        retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000), dryrun: bool=False):
     """Brings a channels own liquidity to X percent using circular payments.
 
     Percentage defaults to 50, resulting in a balanced channel.
     Chunks defaults to 0 (auto-detect).
     Use 'setbalance 100' to fill a channel. Use 'setbalance 0' to drain a channel.
+    With 'dryrun' it only returns the planned chunks, routes and fees.
     """
-    payload = read_params('setbalance', scid, percentage, chunks, maxfeepercent, retry_for, exemptfee)
+    payload = read_params('setbalance', scid, percentage, chunks, maxfeepercent, retry_for, exemptfee, dryrun)
     return execute(payload)
 
 @plugin.init()
 def init(options, configuration, plugin):
     plugin.options['cltv-final']['value'] = plugin.rpc.listconfigs().get('cltv-final')
+    plugin.liquidity = LiquidityStore(os.path.join(configuration['lightning-dir'], 'liquidity.sqlite3'))
+    plugin.liquidity.prune()
+    plugin.journal = DrainJournal(os.path.join(configuration['lightning-dir'], 'drain.sqlite3'))
+    plugin.journal.prune()
+    plugin.resume = str(options['drain-resume']).lower() in ('true', '1', 'yes')
+    # jobs interrupted by a restart may have to wait for payments in flight
+    t = threading.Thread(target=resume_jobs, args=(plugin,))
+    t.daemon = True
+    t.start()
     plugin.log("Plugin drain.py initialized")
 
 
 plugin.add_option('cltv-final', 10, 'Number of blocks for final CheckLockTimeVerify expiry')
-plugin.run()
+plugin.add_option('drain-parallel', 4, 'Maximum number of chunks that are sent at the same time')
+plugin.add_option('drain-resume', 'false', 'Resume jobs interrupted by a restart, "false" only finalizes them')
+
+if __name__ == "__main__":
+    plugin.run()
@@ -0,0 +1,85 @@
+"""Batched routing fee computation for many routes at once.
+
+The rebalance, drain and sendinvoiceless plugins each ship a copy of this
+module. Routes are given as `(routes, hops)` arrays with the `base`, `ppm`
+and `delay` of the channel each hop uses. Routes shorter than the longest
+one are padded at the front with zero-fee hops, which do not change the
+amounts of the real hops.
+
+All amounts are exact integers in millisatoshi. Fees are rounded up as
+BOLT #7 requires: fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
+"""
+import numpy as np
+
+
+def policy_arrays(routes, policy):
+    """Build padded `base`, `ppm` and `delay` arrays for hop lists.
+
+    `policy(hop)` returns a dict with `base`, `ppm` and `delay` of a hop.
+    """
+    length = max(len(r) for r in routes)
+    base = np.zeros((len(routes), length), dtype=np.int64)
+    ppm = np.zeros((len(routes), length), dtype=np.int64)
+    delay = np.zeros((len(routes), length), dtype=np.int64)
+    for i, route in enumerate(routes):
+        offset = length - len(route)
+        for j, hop in enumerate(route):
+            p = policy(hop)
+            base[i, offset + j] = p['base']
+            ppm[i, offset + j] = p['ppm']
+            delay[i, offset + j] = p['delay']
+    return base, ppm, delay
+
+
+def proportional_fees(amounts, ppm):
+    """ceil(amounts * ppm / 10**6), falling back to python ints on overflow."""
+    if int(abs(amounts).max(initial=0)) * int(ppm.max(initial=0)) >= 2**63:
+        amounts = amounts.astype(object)
+        ppm = ppm.astype(object)
+    return (amounts * ppm + 10**6 - 1) // 10**6  # integer math trick to round up
+
+
+def route_amounts(base, ppm, delay, msatoshi, final_cltv, extra=None):
+    """Amounts and delays of every hop when the last hops deliver `msatoshi`.
+
+    `msatoshi` is a scalar or one amount per route, `extra` an optional array
+    of additional amounts a hop's channel source takes on top of its fee.
+    Returns `(amounts, delays)`, where `amounts[:, 0]` is what the first hop
+    carries, i.e. the amount that has to be sent including all fees.
+    """
+    routes, hops = base.shape
+    amount = np.zeros(routes, dtype=np.int64) + np.asarray(msatoshi, dtype=np.int64)
+    cltv = np.full(routes, final_cltv, dtype=np.int64)
+    amounts = np.zeros((routes, hops), dtype=object)
+    delays = np.zeros((routes, hops), dtype=np.int64)
+    for i in reversed(range(hops)):
+        amounts[:, i] = amount
+        delays[:, i] = cltv
+        fee = base[:, i] + proportional_fees(amount, ppm[:, i])
+        if extra is not None:
+            fee = fee + extra[:, i]
+        amount = amount + fee
+        cltv = cltv + delay[:, i]
+    return amounts, delays
+
+
+def substracted_amounts(base, ppm, msatoshi, lengths=None):
+    """Amounts of every hop when the fees are taken out of `msatoshi`.
+
+    The first hop of a route carries `msatoshi`, every following hop carries
+    the previous amount minus the fee of its channel. `lengths` tells where
+    padded routes really start. Returns `(amounts, ok)`, `ok` is false for
+    routes whose fees exceed the amount.
+    """
+    routes, hops = base.shape
+    first = np.zeros(routes, dtype=np.int64) if lengths is None else hops - np.asarray(lengths)
+    amount = np.zeros(routes, dtype=np.int64) + np.asarray(msatoshi, dtype=np.int64)
+    amounts = np.zeros((routes, hops), dtype=object)
+    ok = np.ones(routes, dtype=bool)
+    amounts[:, 0] = amount
+    for i in range(1, hops):
+        fee = np.where(i > first, base[:, i] + proportional_fees(amount, ppm[:, i]), 0)
+        ok &= fee <= amount
+        amount = amount - fee
+        amounts[:, i] = amount
+    return amounts, ok
@@ -0,0 +1,99 @@
+"""Journal of drain, fill and setbalance jobs in the lightning-dir.
+
+A job is written down once its chunks are planned, together with the
+invoice of every chunk as soon as it is created and whether it got paid.
+When the plugin is restarted in the middle of a job, the journal tells
+which chunks are done, which invoices are left over and which payments may
+still be in flight, so the job can be resumed or finalized without paying a
+chunk twice.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+
+class DrainJournal(object):
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+            job_id TEXT NOT NULL,
+            chunk INTEGER NOT NULL,
+            amount_msat INTEGER NOT NULL,
+            counter_scid TEXT,
+            label TEXT,
+            payment_hash TEXT,
+            status TEXT NOT NULL,
+            PRIMARY KEY (job_id, chunk)
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self.db.commit()
+
+    def start(self, job_id, params, plan):
+        """A job with its parameters and planned `(amount, counter_scid)` chunks."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT INTO jobs (id, params, status, created_at, updated_at) VALUES (?, ?, 'running', ?, ?)",
+                            (job_id, json.dumps(params), now, now))
+            self.db.executemany("INSERT INTO chunks (job_id, chunk, amount_msat, counter_scid, status) "
+                                "VALUES (?, ?, ?, ?, 'planned')",
+                                [(job_id, chunk, int(amount), counter) for chunk, (amount, counter) in enumerate(plan)])
+            self.db.commit()
+
+    def _chunk(self, job_id, chunk, **values):
+        with self.lock:
+            self.db.execute("UPDATE chunks SET %s WHERE job_id=? AND chunk=?" % ", ".join("%s=?" % k for k in values),
+                            list(values.values()) + [job_id, chunk])
+            self.db.execute("UPDATE jobs SET updated_at=? WHERE id=?", (time.time(), job_id))
+            self.db.commit()
+
+    def invoice(self, job_id, chunk, label, payment_hash):
+        self._chunk(job_id, chunk, label=label, payment_hash=payment_hash, status='invoiced')
+
+    def sent(self, job_id, chunk):
+        """A payment of the chunk may be in flight from now on."""
+        self._chunk(job_id, chunk, status='sent')
+
+    def paid(self, job_id, chunk):
+        self._chunk(job_id, chunk, status='paid')
+
+    def finish(self, job_id, status):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status=?, updated_at=? WHERE id=?", (status, time.time(), job_id))
+            self.db.commit()
+
+    def unfinished(self):
+        """All jobs still running, with their parameters and chunks."""
+        with self.lock:
+            jobs = self.db.execute("SELECT id, params, created_at FROM jobs WHERE status='running' "
+                                   "ORDER BY created_at").fetchall()
+            result = []
+            for job_id, params, created_at in jobs:
+                chunks = self.db.execute("SELECT chunk, amount_msat, counter_scid, label, payment_hash, status "
+                                         "FROM chunks WHERE job_id=? ORDER BY chunk", (job_id,)).fetchall()
+                result.append({
+                    'id': job_id,
+                    'params': json.loads(params),
+                    'created_at': created_at,
+                    'chunks': [dict(zip(['chunk', 'amount_msat', 'counter_scid', 'label', 'payment_hash', 'status'], c))
+                               for c in chunks],
+                })
+        return result
+
+    def prune(self, max_age=30 * 86400):
+        """Forget finished jobs older than `max_age` seconds."""
+        with self.lock:
+            old = "SELECT id FROM jobs WHERE status != 'running' AND updated_at < ?"
+            self.db.execute("DELETE FROM chunks WHERE job_id IN (%s)" % old, (time.time() - max_age,))
+            self.db.execute("DELETE FROM jobs WHERE status != 'running' AND updated_at < ?", (time.time() - max_age,))
+            self.db.commit()
@@ -0,0 +1,254 @@
+from drain import assign_chunks, MAX_CHUNKS
+from journal import DrainJournal
+from liquidity import LiquidityStore
+from pyln.client import Millisatoshi, RpcError
+import drain
+import os
+import pytest
+import tempfile
+
+MY_ID = '02' + '00' * 32
+
+
+def sizes(plan):
+    return [(int(amount), scid) for amount, scid in plan]
+
+
+def test_assign_chunks_equal_split():
+    assert sizes(assign_chunks(1000, {'2x1x0': 5000}, {}, 4)) == [(250, '2x1x0')] * 4
+    # odd amounts put the extra msat into the first chunks
+    assert sizes(assign_chunks(1001, {'2x1x0': 5000}, {}, 2)) == [(501, '2x1x0'), (500, '2x1x0')]
+
+
+def test_assign_chunks_capacity_limits():
+    capacities = {'2x1x0': 600, '3x1x0': 300, '4x1x0': 0}
+    assert sizes(assign_chunks(800, capacities, {})) == [(600, '2x1x0'), (200, '3x1x0')]
+    assert assign_chunks(1000, capacities, {}) is None
+    assert assign_chunks(0, capacities, {}) is None
+    # one chunk per channel at least, more channels than chunks do not fit
+    assert assign_chunks(800, capacities, {}, 1) is None
+
+
+def test_assign_chunks_cheapest_first():
+    capacities = {'2x1x0': 1000, '3x1x0': 1000}
+    costs = {'2x1x0': (1000, 500), '3x1x0': (0, 10)}
+    assert sizes(assign_chunks(500, capacities, costs)) == [(500, '3x1x0')]
+    # the rest goes to the next cheapest channel
+    assert sizes(assign_chunks(1500, capacities, costs)) == [(1000, '3x1x0'), (500, '2x1x0')]
+
+
+def test_assign_chunks_auto_limit():
+    capacities = dict(('%dx1x0' % i, 100) for i in range(2, 2 + MAX_CHUNKS))
+    capacities['99x1x0'] = 1000
+    costs = {'99x1x0': (0, 1000)}
+    # the cheap small channels need too many chunks, the big one is used first then
+    plan = assign_chunks(2000, capacities, costs)
+    assert plan[0] == (Millisatoshi(1000), '99x1x0') and len(plan) == 11
+    assert assign_chunks(100 * (MAX_CHUNKS + 1), dict(('%dx1x0' % i, 100) for i in range(MAX_CHUNKS + 1)), {}) is None
+
+
+class FakeRpc(object):
+
+    def __init__(self, policies):
+        self.policies = policies
+
+    def listchannels(self, short_channel_id=None, destination=None):
+        return {'channels': [c for c in self.policies if destination in (None, c['destination'])
+                             and short_channel_id in (None, c['short_channel_id'])]}
+
+
+class FakePlugin(object):
+
+    def __init__(self, policies=()):
+        self.rpc = FakeRpc(list(policies))
+
+
+def channel(peer, spendable, receivable):
+    return {'peer_id': peer, 'connected': True, 'state': 'CHANNELD_NORMAL', 'htlc_fee': Millisatoshi(0),
+            'spendable': Millisatoshi(spendable), 'receivable': Millisatoshi(receivable)}
+
+
+def payload(command, chunks=0):
+    return {
+        'command': command,
+        'scid': '1x1x0',
+        'percentage': 100,
+        'chunks': chunks,
+        'maxfeepercent': 0.5,
+        'snapshot': {
+            '1x1x0': channel('03' * 33, 900000, 100000),
+            '2x1x0': channel('04' * 33, 201000, 500000),
+            '3x1x0': channel('05' * 33, 800000, 600000),
+        },
+    }
+
+
+def policy(scid, source, base, ppm):
+    return {'short_channel_id': scid, 'source': source, 'destination': MY_ID,
+            'base_fee_millisatoshi': base, 'fee_per_millionth': ppm}
+
+
+def test_drain_plans_over_receivable_of_cheapest_peers():
+    p = payload('drain')
+    plugin = FakePlugin([policy('2x1x0', '04' * 33, 0, 1), policy('3x1x0', '05' * 33, 1000, 2000)])
+    drain.test_or_set_chunks(plugin, p, MY_ID)
+    assert sizes(p['plan']) == [(500000, '2x1x0'), (400000, '3x1x0')]
+    assert p['chunks'] == 2
+
+
+def test_fill_plans_over_spendable_with_room_for_fees():
+    p = payload('fill', chunks=3)
+    drain.test_or_set_chunks(FakePlugin(), p, MY_ID)
+    assert sum(int(a) for a, _ in p['plan']) == 100000 and len(p['plan']) == 3
+    # the counter channel also has to send the fees of maxfeepercent
+    p['snapshot']['3x1x0'] = channel('05' * 33, 0, 0)
+    p['snapshot']['2x1x0'] = channel('04' * 33, 100400, 0)
+    p['chunks'] = 0
+    with pytest.raises(RpcError):
+        drain.test_or_set_chunks(FakePlugin(), p, MY_ID)
+    p['snapshot']['2x1x0'] = channel('04' * 33, 100600, 0)
+    drain.test_or_set_chunks(FakePlugin(), p, MY_ID)
+    assert sizes(p['plan']) == [(100000, '2x1x0')]
+
+
+def test_chunks_that_do_not_fit():
+    p = payload('fill')
+    p['snapshot']['2x1x0'] = channel('04' * 33, 0, 0)
+    p['snapshot']['3x1x0'] = channel('05' * 33, 0, 0)
+    with pytest.raises(RpcError, match='Outgoing capacity problem'):
+        drain.test_or_set_chunks(FakePlugin(), p, MY_ID)
+    p = payload('drain', chunks=1)
+    with pytest.raises(RpcError, match='will not fit incoming channel capacities'):
+        drain.test_or_set_chunks(FakePlugin(), p, MY_ID)
+
+
+PEER = '03' * 33
+COUNTER_PEER = '04' * 33
+
+
+class PaymentRpc(object):
+    """Our channel 1x1x0 to PEER is drained over 3x1x0 back through 2x1x0."""
+
+    def __init__(self):
+        self.ours = {'1x1x0': 900000000, '2x1x0': 100000000}
+        self.invoices = {}  # label -> (payment_hash, status)
+        self.pending = {}   # payment_hash -> route, payments in flight
+        self.sent = []
+        self.deleted = []
+
+    def getinfo(self):
+        return {'id': MY_ID}
+
+    def listpeers(self, peer_id=None):
+        peers = []
+        for scid, peer in (('1x1x0', PEER), ('2x1x0', COUNTER_PEER)):
+            ours = self.ours[scid]
+            peers.append({'id': peer, 'connected': True, 'channels': [{
+                'short_channel_id': scid, 'state': 'CHANNELD_NORMAL', 'opener': 'remote',
+                'to_us_msat': Millisatoshi(ours), 'total_msat': Millisatoshi(10**9),
+                'our_reserve_msat': Millisatoshi(10**7), 'their_reserve_msat': Millisatoshi(10**7),
+                'spendable_msat': Millisatoshi(ours - 10**7)}]})
+        return {'peers': [p for p in peers if peer_id in (None, p['id'])]}
+
+    def listchannels(self, short_channel_id=None, destination=None):
+        channels = [(short, source, dest) for short, source, dest in (
+            ('1x1x0', MY_ID, PEER), ('3x1x0', PEER, COUNTER_PEER), ('2x1x0', COUNTER_PEER, MY_ID))]
+        return {'channels': [{'short_channel_id': short, 'source': source, 'destination': dest,
+                              'base_fee_millisatoshi': 1000, 'fee_per_millionth': 100, 'delay': 6}
+                             for short, source, dest in channels
+                             if short_channel_id in (None, short) and destination in (None, dest)]}
+
+    def getroute(self, node_id, msatoshi, riskfactor, cltv=9, fromid=None, fuzzpercent=0, exclude=[]):
+        return {'route': [{'id': COUNTER_PEER, 'channel': '3x1x0', 'direction': 0}]}
+
+    def invoice(self, msatoshi, label, description, expiry=None):
+        payment_hash = '%064x' % len(self.invoices)
+        self.invoices[label] = (payment_hash, 'unpaid')
+        return {'payment_hash': payment_hash}
+
+    def listinvoices(self, label=None):
+        return {'invoices': [{'label': l, 'status': s} for l, (_, s) in self.invoices.items()]}
+
+    def delinvoice(self, label, status):
+        self.deleted.append(label)
+        del self.invoices[label]
+
+    def sendpay(self, route, payment_hash, label=None):
+        self.sent.append(payment_hash)
+        self.pending[payment_hash] = route
+
+    def listsendpays(self, payment_hash=None):
+        return {'payments': [{'status': 'pending'}] if payment_hash in self.pending else []}
+
+    def waitsendpay(self, payment_hash, timeout=None):
+        route = self.pending.pop(payment_hash)
+        self.ours[route[0]['channel']] -= route[0]['msatoshi']
+        self.ours[route[-1]['channel']] += route[-1]['msatoshi']
+        label = next(l for l, (h, _) in self.invoices.items() if h == payment_hash)
+        self.invoices[label] = (payment_hash, 'paid')
+        return {'status': 'complete'}
+
+
+class JobPlugin(object):
+
+    def __init__(self, resume):
+        directory = tempfile.mkdtemp()
+        self.rpc = PaymentRpc()
+        self.journal = DrainJournal(os.path.join(directory, 'drain.sqlite3'))
+        self.liquidity = LiquidityStore(os.path.join(directory, 'liquidity.sqlite3'))
+        self.resume = resume
+        self.options = {'cltv-final': 10, 'drain-parallel': 2}
+
+    def get_option(self, name):
+        return self.options[name]
+
+    def log(self, message, level='info'):
+        pass
+
+
+def interrupted_job(plugin, chunks):
+    """A drain of `chunks` chunks of 100000 sat, the first one paid before the restart."""
+    params = {'command': 'drain', 'scid': '1x1x0', 'percentage': 20, 'chunks': chunks,
+              'maxfeepercent': 0.5, 'retry_for': 10, 'exemptfee': 5000}
+    plugin.journal.start('job', params, [(10**8, '2x1x0')] * chunks)
+    payment_hash = plugin.rpc.invoice('any', 'paid-label', '')['payment_hash']
+    plugin.rpc.invoices['paid-label'] = (payment_hash, 'paid')
+    plugin.journal.invoice('job', 0, 'paid-label', payment_hash)
+    plugin.journal.paid('job', 0)
+
+
+def job_state(plugin):
+    job = plugin.journal.db.execute("SELECT status FROM jobs WHERE id='job'").fetchone()[0]
+    chunks = plugin.journal.db.execute("SELECT status FROM chunks WHERE job_id='job' ORDER BY chunk").fetchall()
+    return job, [c[0] for c in chunks]
+
+
+def test_finalize_interrupted_job():
+    plugin = JobPlugin(resume=False)
+    interrupted_job(plugin, 3)
+    # chunk 1 was in flight during the restart, chunk 2 got no payment
+    for chunk, label in ((1, 'sent-label'), (2, 'unpaid-label')):
+        payment_hash = plugin.rpc.invoice('any', label, '')['payment_hash']
+        plugin.journal.invoice('job', chunk, label, payment_hash)
+    plugin.journal.sent('job', 1)
+    plugin.rpc.pending[plugin.rpc.invoices['sent-label'][0]] = [
+        {'channel': '1x1x0', 'msatoshi': 10**8 + 2000}, {'channel': '2x1x0', 'msatoshi': 10**8}]
+
+    result = drain.resume_job(plugin, plugin.journal.unfinished()[0])
+    assert 'Partially completed 2/3 chunks' in result[-1]
+    # the payment in flight was waited for, nothing was sent again
+    assert plugin.rpc.sent == [] and plugin.rpc.pending == {}
+    assert plugin.rpc.deleted == ['unpaid-label']
+    assert job_state(plugin) == ('partial', ['paid', 'paid', 'invoiced'])
+    assert plugin.journal.unfinished() == []
+
+
+def test_resume_skips_paid_chunks():
+    plugin = JobPlugin(resume=True)
+    interrupted_job(plugin, 2)
+    result = drain.resume_job(plugin, plugin.journal.unfinished()[0])
+    assert len(result) == 1 and 'drain 100000000msat [2/2]' in result[0]
+    # only the chunk that was not paid is sent
+    assert len(plugin.rpc.sent) == 1
+    assert job_state(plugin) == ('done', ['paid', 'paid'])
+    assert plugin.journal.unfinished() == []
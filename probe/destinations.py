@@ -0,0 +1,112 @@
+"""Selection of probe destinations.
+
+The network is indexed from one `listchannels` call, refreshed once it is
+older than `max_age` seconds, instead of listing all nodes for every probe.
+Only nodes with active channels can be picked, which leaves out most of the
+offline leaf nodes. The index also knows when a probe route last went
+through every channel, so probes can be sent where we know least.
+
+Strategies:
+
+ - `random`: every node with channels is equally likely.
+ - `capacity`: nodes are picked in proportion to the capacity of their
+   channels.
+ - `stale`: the destination of the channel probed longest ago, out of a
+   sample of `SAMPLE` channels.
+ - `coverage`: the destination of a channel no probe went through yet,
+   `stale` once a sample has none.
+"""
+from datetime import datetime
+from pyln.client import Millisatoshi
+import bisect
+import random
+import threading
+import time
+
+
+STRATEGIES = ['random', 'capacity', 'stale', 'coverage']
+
+# Number of channels the `stale` and `coverage` strategies look at per pick.
+SAMPLE = 32
+
+
+def capacity_msat(channel):
+    """The capacity of a `listchannels` entry, newer lightningd versions only
+    report `amount_msat`."""
+    if 'amount_msat' in channel:
+        return int(Millisatoshi(channel['amount_msat']))
+    return int(channel['satoshis']) * 1000
+
+
+class DestinationIndex(object):
+
+    def __init__(self, rpc, max_age=3600, rnd=None):
+        self.rpc = rpc
+        self.max_age = max_age
+        self.rnd = rnd or random.Random()
+        self.lock = threading.Lock()
+        self.updated_at = 0
+        self.nodes = []
+        self.cum_capacity = []
+        self.channels = []   # (short_channel_id, destination) of every active direction
+        self.observed = {}   # short_channel_id -> when a probe route last went through it
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.updated_at < self.max_age:
+            return
+        capacity = {}
+        channels = []
+        for c in self.rpc.listchannels()['channels']:
+            if not c.get('active', True):
+                continue
+            channels.append((c['short_channel_id'], c['destination']))
+            capacity[c['source']] = capacity.get(c['source'], 0) + capacity_msat(c)
+        nodes = sorted(capacity)
+        cum, total = [], 0
+        for n in nodes:
+            total += capacity[n]
+            cum.append(total)
+        with self.lock:
+            self.nodes = nodes
+            self.cum_capacity = cum
+            self.channels = channels
+            self.updated_at = time.time()
+
+    def load(self, last_probed):
+        """Take the `{short_channel_id: started_at}` of past probes from the store."""
+        with self.lock:
+            for channel, started_at in last_probed.items():
+                self.observed[channel] = datetime.strptime(started_at[:19], '%Y-%m-%d %H:%M:%S').timestamp()
+
+    def observe(self, route, erring_index=None):
+        """Note that a probe went through `route` now.
+
+        A probe that failed at `erring_index` never got past that hop, the
+        channels after it are left alone.
+        """
+        if erring_index is not None:
+            route = route[:erring_index + 1]
+        now = time.time()
+        with self.lock:
+            for hop in route:
+                self.observed[hop['channel']] = now
+
+    def pick(self, strategy='random'):
+        """A destination node chosen by `strategy`, `None` if the network is empty."""
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy {}, use one of {}".format(strategy, ', '.join(STRATEGIES)))
+        self.refresh()
+        with self.lock:
+            if not self.nodes:
+                return None
+            if strategy == 'random':
+                return self.rnd.choice(self.nodes)
+            if strategy == 'capacity':
+                x = self.rnd.random() * self.cum_capacity[-1]
+                return self.nodes[min(bisect.bisect_right(self.cum_capacity, x), len(self.nodes) - 1)]
+            sample = [self.rnd.choice(self.channels) for _ in range(SAMPLE)]
+            if strategy == 'coverage':
+                unprobed = [c for c in sample if c[0] not in self.observed]
+                if unprobed:
+                    return unprobed[0][1]
+            return min(sample, key=lambda c: self.observed.get(c[0], 0))[1]
@@ -0,0 +1,109 @@
+"""Channels excluded from probe and traceroute routes.
+
+Channels that failed permanently are excluded for good, the ones that failed
+temporarily until their expiry. Every channel direction is in the set once,
+adding it again refreshes it. Expiries are kept in a heap, so expiring is
+cheap however many entries there are, and when the set grows beyond its
+capacity the least recently added entries are evicted. The set is kept in
+`probes.db`, so a restart does not forget it.
+"""
+from collections import OrderedDict
+import heapq
+import sqlite3
+import threading
+import time
+
+
+class ExclusionSet(object):
+
+    def __init__(self, path, capacity=10000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # channel direction -> expiry or None, least recent first
+        self.heap = []
+        self.cached = None  # the list for getroute, until the set changes
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS exclusions (
+            exclusion VARCHAR PRIMARY KEY,
+            expires_at REAL,
+            added_at REAL NOT NULL
+        )""")
+        self.db.execute("DELETE FROM exclusions WHERE expires_at < ?", (time.time(),))
+        self.db.commit()
+        for exclusion, expiry in self.db.execute("SELECT exclusion, expires_at FROM exclusions ORDER BY added_at"):
+            self._insert(exclusion, expiry)
+        self._evict()
+
+    def _insert(self, exclusion, expiry):
+        self.cached = None
+        self.entries.pop(exclusion, None)
+        self.entries[exclusion] = expiry
+        if expiry is not None:
+            heapq.heappush(self.heap, (expiry, exclusion))
+
+    def _evict(self):
+        evicted = []
+        while len(self.entries) > self.capacity:
+            self.cached = None
+            evicted.append(self.entries.popitem(last=False)[0])
+        return evicted
+
+    def _delete(self, exclusions):
+        if exclusions:
+            self.db.executemany("DELETE FROM exclusions WHERE exclusion = ?", [(e,) for e in exclusions])
+
+    def add(self, exclusion, ttl=None):
+        """Exclude `exclusion`, e.g. `"103x1x0/1"`, for `ttl` seconds or for good.
+
+        A permanent exclusion is not turned into a temporary one.
+        """
+        now = time.time()
+        with self.lock:
+            expiry = now + ttl if ttl is not None else None
+            if exclusion in self.entries and self.entries[exclusion] is None:
+                expiry = None
+            self._insert(exclusion, expiry)
+            self.db.execute("INSERT OR REPLACE INTO exclusions (exclusion, expires_at, added_at) VALUES (?, ?, ?)",
+                            (exclusion, expiry, now))
+            self._delete(self._evict())
+            self.db.commit()
+
+    def expire(self):
+        """Drop the temporary exclusions that expired, returns how many."""
+        now = time.time()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expiry, exclusion = heapq.heappop(self.heap)
+                # entries that were refreshed or evicted leave stale heap items behind
+                if self.entries.get(exclusion, -1) == expiry:
+                    del self.entries[exclusion]
+                    expired.append(exclusion)
+                    self.cached = None
+            if expired:
+                self._delete(expired)
+                self.db.commit()
+        return len(expired)
+
+    def __contains__(self, exclusion):
+        with self.lock:
+            expiry = self.entries.get(exclusion, -1)
+        return expiry is None or expiry > time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def list(self):
+        """All current exclusions, as `getroute` takes them."""
+        self.expire()
+        with self.lock:
+            if self.cached is None:
+                self.cached = list(self.entries)
+            return self.cached
+
+    def counts(self):
+        """The number of permanent and temporary exclusions."""
+        with self.lock:
+            permanent = sum(1 for e in self.entries.values() if e is None)
+        return permanent, len(self.entries) - permanent
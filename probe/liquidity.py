@@ -0,0 +1,122 @@
+"""Persistent memory of payment failures and channel liquidity.
+
+The rebalance, drain, sendinvoiceless and probe plugins each ship a copy of
+this module and share one sqlite3 database in the lightning-dir, so what one of
+them learns from failed attempts is used by all of them.
+
+Every channel direction (`scid/direction`) keeps a count of non-liquidity
+failures and bounds of the amount it was seen to forward or refuse. All
+observations lose weight with a half-life: failure counts decay towards
+zero, a lower bound shrinks and an upper bound grows back towards unknown.
+"""
+import sqlite3
+import threading
+import time
+
+# seconds after which an observation only counts half
+HALF_LIFE = 3600
+
+# temporary_channel_failure, the usual answer of a channel lacking liquidity
+TEMPORARY_CHANNEL_FAILURE = 0x1007
+
+
+class LiquidityStore(object):
+
+    def __init__(self, path, half_life=HALF_LIFE):
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        # several plugins use the same file, wait for each other's writes
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS liquidity (
+            channel TEXT PRIMARY KEY,
+            failures REAL NOT NULL DEFAULT 0,
+            min_msat INTEGER,
+            max_msat INTEGER,
+            updated_at REAL NOT NULL
+        )""")
+        self.db.commit()
+
+    def _decay(self, updated_at, now):
+        return 0.5 ** ((now - updated_at) / self.half_life)
+
+    def _load(self, channel, now):
+        row = self.db.execute("SELECT failures, min_msat, max_msat, updated_at FROM liquidity WHERE channel=?",
+                              (channel,)).fetchone()
+        if row is None:
+            return 0.0, None, None
+        return self._current(row, now)
+
+    def _current(self, row, now):
+        failures, min_msat, max_msat, updated_at = row
+        decay = self._decay(updated_at, now)
+        if decay < 2**-10:
+            return failures * decay, None, None
+        if min_msat is not None:
+            min_msat = int(min_msat * decay)
+        if max_msat is not None:
+            max_msat = int(max_msat / decay)
+        return failures * decay, min_msat, max_msat
+
+    def _store(self, channel, failures, min_msat, max_msat, now):
+        self.db.execute("INSERT OR REPLACE INTO liquidity (channel, failures, min_msat, max_msat, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?)", (channel, failures, min_msat, max_msat, now))
+
+    def record_failure(self, channel, msatoshi, failcode):
+        """`channel` refused to forward `msatoshi` with `failcode`."""
+        now = time.time()
+        with self.lock:
+            failures, min_msat, max_msat = self._load(channel, now)
+            if failcode == TEMPORARY_CHANNEL_FAILURE:
+                max_msat = int(msatoshi) if max_msat is None else min(max_msat, int(msatoshi))
+                if min_msat is not None and min_msat >= max_msat:
+                    min_msat = None
+            else:
+                failures += 1
+            self._store(channel, failures, min_msat, max_msat, now)
+            self.db.commit()
+
+    def record_success(self, route):
+        """Every hop of `route` forwarded its amount."""
+        now = time.time()
+        with self.lock:
+            for hop in route:
+                channel = "%s/%d" % (hop['channel'], hop['direction'])
+                failures, min_msat, max_msat = self._load(channel, now)
+                msatoshi = int(hop['msatoshi'])
+                min_msat = msatoshi if min_msat is None else max(min_msat, msatoshi)
+                if max_msat is not None and max_msat <= min_msat:
+                    max_msat = None
+                self._store(channel, failures, min_msat, max_msat, now)
+            self.db.commit()
+
+    def estimate(self, channel):
+        """Current `(failures, min_msat, max_msat)` of a channel direction,
+        the bounds are `None` while unknown."""
+        now = time.time()
+        with self.lock:
+            return self._load(channel, now)
+
+    def excludes(self, msatoshi, max_failures=0.5):
+        """Channel directions not worth trying for a payment of `msatoshi`.
+
+        These recently failed for other reasons than liquidity, or are known
+        to be unable to forward that amount.
+        """
+        now = time.time()
+        result = []
+        with self.lock:
+            rows = self.db.execute("SELECT channel, failures, min_msat, max_msat, updated_at FROM liquidity").fetchall()
+        for row in rows:
+            failures, _, max_msat = self._current(row[1:], now)
+            if failures >= max_failures or (max_msat is not None and max_msat <= int(msatoshi)):
+                result.append(row[0])
+        return result
+
+    def prune(self, max_age=None):
+        """Forget observations that have decayed to almost nothing."""
+        if max_age is None:
+            max_age = 10 * self.half_life
+        with self.lock:
+            self.db.execute("DELETE FROM liquidity WHERE updated_at < ?", (time.time() - max_age,))
+            self.db.commit()
@@ -33,40 +33,50 @@ Failcode -1 and 16399 are special:
    `payment_hash` at random :-)
 
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from pyln.client import Plugin, RpcError
-from random import choice
-from sqlalchemy import Column, Integer, String, DateTime
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from destinations import DestinationIndex, STRATEGIES, capacity_msat
+from exclusions import ExclusionSet
+from liquidity import LiquidityStore
+from pyln.client import Millisatoshi, Plugin, RpcError
+from store import ProbeStore, SUCCESS_FAILCODE
 from time import sleep, time
 import heapq
 import json
 import os
 import random
-import string
 import threading
 
 
-Base = declarative_base()
 plugin = Plugin()
 
-exclusions = []
-temporary_exclusions = {}
+# Probes are resolved by notifications, the ones still pending after this
+# many seconds are checked with `listsendpays` in case we missed one.
+PROBE_POLL_AGE = 60
 
+# temporary_channel_failure, what a channel lacking liquidity answers
+TEMPORARY_CHANNEL_FAILURE = 4103
 
-class Probe(Base):
-    __tablename__ = "probes"
-    id = Column(Integer, primary_key=True)
-    destination = Column(String)
-    route = Column(String)
-    error = Column(String)
-    erring_channel = Column(String)
-    failcode = Column(Integer)
-    payment_hash = Column(String)
-    started_at = Column(DateTime)
-    finished_at = Column(DateTime)
+# Destinations a single traceroute call traces at the same time.
+TRACEROUTE_PARALLEL = 8
+
+# Searching the liquidity of a channel stops once the bounds are closer
+# than this share of its capacity.
+LIQUIDITY_PRECISION = 0.01
+
+
+class Probe(object):
+    def __init__(self, destination, started_at):
+        self.id = None
+        self.destination = destination
+        self.route = None
+        self.hops = None
+        self.error = None
+        self.erring_channel = None
+        self.failcode = None
+        self.payment_hash = None
+        self.started_at = started_at
+        self.finished_at = None
 
     def jsdict(self):
         return {
@@ -79,50 +89,92 @@ class Probe(Base):
             'finished_at': str(self.finished_at),
         }
 
+    def record(self):
+        """What the store needs to write the probe."""
+        res = self.jsdict()
+        res.update(hops=self.hops, payment_hash=self.payment_hash, error=self.error)
+        return res
+
+
+def random_hash():
+    return '%064x' % random.getrandbits(256)
+
+
 def start_probe(plugin):
-    t = threading.Thread(target=probe, args=[plugin, None])
-    t.daemon = True
-    t.start()
+    """Start another probe, unless `probe-parallel` probes are in flight.
+
+    A probe that has to wait is started as soon as one of them is resolved,
+    so the probe rate holds while the network is slow to answer.
+    """
+    with plugin.pending_lock:
+        if len(plugin.pending_probes) >= plugin.probe_parallel:
+            plugin.probes_due = min(plugin.probes_due + 1, plugin.probe_parallel)
+            return
+    try:
+        probe(plugin, None)
+    except Exception as e:
+        plugin.log("Could not start probe: {}".format(e), level='warn')
 
 
 @plugin.async_method('probe')
-def probe(plugin, request, node_id=None, **kwargs):
-    res = None
+def probe(plugin, request, node_id=None, strategy=None, **kwargs):
     if node_id is None:
-        nodes = plugin.rpc.listnodes()['nodes']
-        node_id = choice(nodes)['nodeid']
+        node_id = plugin.destinations.pick(strategy or plugin.probe_strategy)
+        if node_id is None:
+            raise RpcError('probe', {}, {'message': 'No destination to probe, the network is empty'})
 
-    s = plugin.Session()
     p = Probe(destination=node_id, started_at=datetime.now())
-    s.add(p)
     try:
         route = plugin.rpc.getroute(
             node_id,
             msatoshi=10000,
             riskfactor=1,
-            exclude=exclusions + list(temporary_exclusions.keys())
+            exclude=plugin.exclusions.list()
         )['route']
         p.route = ','.join([r['channel'] for r in route])
-        p.payment_hash = ''.join(choice(string.hexdigits) for _ in range(64))
+        p.hops = route
+        p.payment_hash = random_hash()
     except RpcError:
         p.failcode = -1
-        res = p.jsdict()
-        s.commit()
-        return request.set_result(res) if request else None
-
-    s.commit()
-    plugin.rpc.sendpay(route, p.payment_hash)
-    plugin.pending_probes.append({
-        'request': request,
-        'probe_id': p.id,
-        'payment_hash': p.payment_hash,
-        'callback': complete_probe,
-        'plugin': plugin,
-    })
-
-
-@plugin.method('traceroute')
-def traceroute(plugin, node_id, **kwargs):
+        return store_probe(plugin, request, p)
+
+    # The probe has to be pending before it is sent, the notification about
+    # its outcome may arrive before `sendpay` returns.
+    with plugin.pending_lock:
+        plugin.pending_probes[p.payment_hash] = {
+            'request': request,
+            'probe': p,
+            'started_at': time(),
+        }
+    try:
+        plugin.rpc.sendpay(route, p.payment_hash)
+    except RpcError as e:
+        resolve_probe(plugin, p.payment_hash, e.error)
+
+
+def send_prefix(plugin, probe, timeout):
+    """Send one traceroute probe and wait for the hop it ends at to reject it."""
+    start = time()
+    probe['started_at'] = str(datetime.now())
+    try:
+        plugin.rpc.sendpay(probe['route'], probe['payment_hash'])
+        plugin.rpc.waitsendpay(probe['payment_hash'], timeout=timeout)
+        raise ValueError("The recipient guessed the preimage? Cryptography is broken!!!")
+    except RpcError as e:
+        probe['finished_at'] = str(datetime.now())
+        probe['latency_ms'] = int((time() - start) * 1000)
+        if e.error['code'] == 200:
+            probe['error'] = "Timeout"
+        else:
+            probe['error'] = e.error.get('data', e.error.get('message'))
+            if 'data' in e.error:
+                probe['failcode'] = e.error['data'].get('failcode')
+                exclude_failure(plugin, e.error['data'])
+                record_liquidity(plugin, probe['route'], e.error['data'])
+    return probe
+
+
+def trace(plugin, node_id, timeout):
     traceroute = {
         'destination': node_id,
         'started_at': str(datetime.now()),
@@ -133,101 +185,342 @@ def traceroute(plugin, node_id, **kwargs):
             traceroute['destination'],
             msatoshi=10000,
             riskfactor=1,
+            exclude=plugin.exclusions.list()
         )['route']
-        traceroute['payment_hash'] = ''.join(random.choice(string.hexdigits) for _ in range(64))
+        traceroute['payment_hash'] = random_hash()
     except RpcError:
         traceroute['failcode'] = -1
         return traceroute
 
-    # For each prefix length, shorten the route and attempt the payment
+    # Send a probe for each prefix of the route at the same time, each with
+    # its own payment_hash, and collect them as they fail.
+    probes = []
     for l in range(1, len(traceroute['route'])+1):
         probe = {
             'route': traceroute['route'][:l],
-            'payment_hash': ''.join(random.choice(string.hexdigits) for _ in range(64)),
-            'started_at': str(datetime.now()),
+            'payment_hash': random_hash(),
         }
         probe['destination'] = probe['route'][-1]['id']
-        plugin.rpc.sendpay(probe['route'], probe['payment_hash'])
+        probes.append(probe)
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = [executor.submit(send_prefix, plugin, probe, timeout) for probe in probes]
+        for future in as_completed(futures):
+            future.result()
+
+    # The latency of a hop is how much longer the probe ending there took
+    # than the one ending at the hop before. The probes run at the same time,
+    # so a longer prefix may come back first, which counts as no latency.
+    previous = 0
+    for probe in probes:
+        if 'latency_ms' in probe and probe.get('error') != "Timeout":
+            probe['hop_latency_ms'] = max(probe['latency_ms'] - previous, 0)
+            previous = max(probe['latency_ms'], previous)
+    traceroute['probes'] = probes
+    return traceroute
 
+
+@plugin.async_method('traceroute')
+def traceroute(plugin, request, node_id, timeout=30, **kwargs):
+    """Probe every prefix of the route to `node_id`, or to each of a list of nodes.
+    """
+    def run():
         try:
-            plugin.rpc.waitsendpay(probe['payment_hash'], timeout=30)
-            raise ValueError("The recipient guessed the preimage? Cryptography is broken!!!")
-        except RpcError as e:
-            probe['finished_at'] = str(datetime.now())
-            if e.error['code'] == 200:
-                probe['error'] = "Timeout"
-                break
+            if isinstance(node_id, list):
+                with ThreadPoolExecutor(max_workers=TRACEROUTE_PARALLEL) as executor:
+                    traceroutes = list(executor.map(lambda n: trace(plugin, n, int(timeout)), node_id))
+                request.set_result({'traceroutes': traceroutes})
             else:
-                probe['error'] = e.error['data']
-                probe['failcode'] = e.error['data']['failcode']
+                request.set_result(trace(plugin, node_id, int(timeout)))
+        except Exception as e:
+            request.set_exception(e)
 
-        traceroute['probes'].append(probe)
-
-    return traceroute
+    # Waiting for the probes must not block the notifications that
+    # complete the regular probes.
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
 
 
 @plugin.method('probe-stats')
 def stats(plugin):
+    permanent, temporary = plugin.exclusions.counts()
     return {
         'pending_probes': len(plugin.pending_probes),
-        'exclusions': len(exclusions),
-        'temporary_exclusions': len(temporary_exclusions),
+        'exclusions': permanent,
+        'temporary_exclusions': temporary,
     }
 
 
-def complete_probe(plugin, request, probe_id, payment_hash):
-    s = plugin.Session()
-    p = s.query(Probe).get(probe_id)
-    try:
-        plugin.rpc.waitsendpay(p.payment_hash)
-    except RpcError as e:
-        error = e.error['data']
-        p.erring_channel = e.error['data']['erring_channel']
-        p.failcode = e.error['data']['failcode']
-        p.error = json.dumps(error)
+def store_probe(plugin, request, p):
+    p.id = plugin.store.new_id()
+    p.finished_at = datetime.now()
+    plugin.store.add(p.record())
+    if request is not None:
+        request.set_result(p.jsdict())
 
-    if p.failcode in [16392, 16394]:
+
+@plugin.method('probe-query')
+def query(plugin, start=None, end=None, channel=None, destination=None, days=1, bucket=3600, limit=100):
+    """Aggregated probe results.
+
+    Failure rates of the channels probes went through, the worst first, and
+    the success rate of all probes per `bucket` seconds. Covers the probes
+    started between `start` and `end` (unix timestamps, default: the last
+    `days` days), optionally only those through `channel` or to `destination`.
+    """
+    end = float(end) if end is not None else time() + 1
+    start = float(start) if start is not None else time() - float(days) * 86400
+    return {
+        'channels': plugin.store.channels(start, end, channel, int(limit)),
+        'buckets': plugin.store.buckets(start, end, int(bucket), destination),
+    }
+
+
+def exclude_failure(plugin, error):
+    """Exclude the channel that made a payment fail from further routes."""
+    if error.get('failcode') in [16392, 16394]:
         exclusion = "{erring_channel}/{erring_direction}".format(**error)
+        plugin.exclusions.add(exclusion)
         print('Adding exclusion for channel {} ({} total))'.format(
-            exclusion, len(exclusions))
+            exclusion, len(plugin.exclusions))
         )
-        exclusions.append(exclusion)
 
-    if p.failcode in [21, 4103]:
+    if error.get('failcode') in [21, 4103]:
         exclusion = "{erring_channel}/{erring_direction}".format(**error)
+        plugin.exclusions.add(exclusion, plugin.probe_exclusion_duration)
         print('Adding temporary exclusion for channel {} ({} total))'.format(
-            exclusion, len(temporary_exclusions))
+            exclusion, len(plugin.exclusions))
         )
-        expiry = time() + plugin.probe_exclusion_duration
-        temporary_exclusions[exclusion] = expiry
 
-    p.finished_at = datetime.now()
-    res = p.jsdict()
-    s.commit()
-    s.close()
-    request.set_result(res)
+
+def record_liquidity(plugin, route, error):
+    """Learn the liquidity of the channels on a probe route from its outcome.
+
+    A probe rejected by its destination went through every hop, a failing
+    one went through the hops before the node that failed it. `error` is
+    the `data` of the failure.
+    """
+    if error is None or error.get('erring_index') is None:
+        return
+    index = error['erring_index']
+    if index >= len(route):
+        if error.get('failcode') == SUCCESS_FAILCODE:
+            plugin.liquidity.record_success(route)
+        return
+    if index > 0:
+        plugin.liquidity.record_success(route[:index])
+    hop = route[index]
+    plugin.liquidity.record_failure("{}/{}".format(hop['channel'], hop['direction']),
+                                    hop['msatoshi'], error.get('failcode'))
+
+
+def probe_amount(plugin, channel, msatoshi, excludes, timeout):
+    """Send a probe that crosses `channel` last, carrying `msatoshi` over it.
+
+    Returns whether the channel could forward the amount, or `None` if the
+    probe failed before reaching it or got no answer. The channel that made
+    it fail is added to `excludes` then.
+    """
+    scid, direction = channel.split('/')
+    half = channel_half(plugin, channel)
+    last = {
+        'id': half['destination'],
+        'channel': scid,
+        'direction': int(direction),
+        'msatoshi': msatoshi,
+        'amount_msat': Millisatoshi(msatoshi),
+        'delay': 9,
+    }
+    if half['source'] == plugin.rpc.getinfo()['id']:
+        route = [last]
+    else:
+        # the source of the channel takes its fee for forwarding over it
+        fee = half['base_fee_millisatoshi'] + (msatoshi * half['fee_per_millionth'] + 10**6 - 1) // 10**6
+        route = plugin.rpc.getroute(
+            half['source'],
+            msatoshi=msatoshi + fee,
+            riskfactor=1,
+            cltv=9 + half['delay'],
+            exclude=plugin.exclusions.list() + excludes + [scid + '/0', scid + '/1']
+        )['route'] + [last]
+
+    payment_hash = random_hash()
+    try:
+        plugin.rpc.sendpay(route, payment_hash)
+        plugin.rpc.waitsendpay(payment_hash, timeout=timeout)
+        raise ValueError("The recipient guessed the preimage? Cryptography is broken!!!")
+    except RpcError as e:
+        if e.error['code'] == 200 or 'data' not in e.error:
+            return None
+        error = e.error['data']
+    exclude_failure(plugin, error)
+    record_liquidity(plugin, route, error)
+    index = error.get('erring_index')
+    if index == len(route) and error.get('failcode') == SUCCESS_FAILCODE:
+        return True
+    if index == len(route) - 1 and error.get('failcode') == TEMPORARY_CHANNEL_FAILURE:
+        return False
+    if error.get('erring_channel') is not None:
+        excludes.append("{erring_channel}/{erring_direction}".format(**error))
+    return None
+
+
+def channel_half(plugin, channel):
+    """The `listchannels` entry of `channel`, a `scid/direction`."""
+    scid, _, direction = channel.partition('/')
+    half = None
+    if direction in ('0', '1'):
+        half = next((c for c in plugin.rpc.listchannels(scid)['channels'] if c['channel_flags'] & 1 == int(direction)), None)
+    if half is None:
+        raise RpcError('probe-channel', {'channel': channel},
+                       {'message': 'Unknown channel {}, expected the scid/direction of a channel in gossip'.format(channel)})
+    return half
+
+
+def search_liquidity(plugin, channel, max_probes, timeout):
+    """Narrow down the liquidity of `channel` with probes of bisected amounts."""
+    capacity = capacity_msat(channel_half(plugin, channel))
+    _, low, high = plugin.liquidity.estimate(channel)
+    low = low or 0
+    high = min(high or capacity, capacity)
+    excludes = []
+    probes = []
+    while len(probes) < max_probes and high - low > capacity * LIQUIDITY_PRECISION:
+        amount = (low + high) // 2
+        try:
+            forwarded = probe_amount(plugin, channel, amount, excludes, timeout)
+        except RpcError:
+            break  # no route to the channel
+        probes.append({'amount_msat': Millisatoshi(amount), 'forwarded': forwarded})
+        if forwarded is True:
+            low = amount
+        elif forwarded is False:
+            high = amount
+    return {
+        'channel': channel,
+        'capacity_msat': Millisatoshi(capacity),
+        'min_msat': Millisatoshi(low),
+        'max_msat': Millisatoshi(high),
+        'probes': probes,
+    }
+
+
+@plugin.async_method('probe-channel')
+def probe_channel(plugin, request, channel, max_probes=8, timeout=30, **kwargs):
+    """Search how much `channel` (scid/direction, or a list of them) can forward.
+    """
+    def run():
+        try:
+            channels = channel if isinstance(channel, list) else [channel]
+            with ThreadPoolExecutor(max_workers=TRACEROUTE_PARALLEL) as executor:
+                results = list(executor.map(lambda c: search_liquidity(plugin, c, int(max_probes), int(timeout)), channels))
+            request.set_result({'channels': results} if isinstance(channel, list) else results[0])
+        except Exception as e:
+            request.set_exception(e)
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+
+
+@plugin.method('probe-liquidity')
+def probe_liquidity(plugin, channel):
+    """What probes and payments told about the liquidity of `channel`.
+
+    Takes a `scid/direction`, or a `scid` for both directions.
+    """
+    channels = [channel] if '/' in channel else [channel + '/0', channel + '/1']
+    res = []
+    for c in channels:
+        failures, min_msat, max_msat = plugin.liquidity.estimate(c)
+        res.append({
+            'channel': c,
+            'min_msat': Millisatoshi(min_msat) if min_msat is not None else None,
+            'max_msat': Millisatoshi(max_msat) if max_msat is not None else None,
+            'failures': failures,
+        })
+    return res[0] if '/' in channel else {'channels': res}
+
+
+def complete_probe(plugin, request, p, error=None):
+    """Store the outcome of a probe, `error` is the failure it got if any.
+    """
+    if error is not None and 'data' in error:
+        p.erring_channel = error['data'].get('erring_channel')
+        p.failcode = error['data'].get('failcode')
+        p.error = json.dumps(error['data'])
+        error = error['data']
+
+    if error is not None:
+        exclude_failure(plugin, error)
+    if p.hops is not None:
+        plugin.destinations.observe(p.hops, error.get('erring_index') if error is not None else None)
+        record_liquidity(plugin, p.hops, error)
+
+    store_probe(plugin, request, p)
+
+
+def resolve_probe(plugin, payment_hash, error=None):
+    """Complete the pending probe with `payment_hash`, if it is one of ours.
+
+    Whoever takes the probe out of `pending_probes` completes it, so a probe
+    is never completed twice.
+    """
+    with plugin.pending_lock:
+        probe = plugin.pending_probes.pop(payment_hash, None)
+        due = probe is not None and plugin.probes_due > 0
+        if due:
+            plugin.probes_due -= 1
+    if probe is None:
+        return
+    complete_probe(plugin, probe['request'], probe['probe'], error)
+    if due:
+        # not from the notification handler, starting a probe takes RPC calls
+        t = threading.Thread(target=start_probe, args=[plugin])
+        t.daemon = True
+        t.start()
+
+
+@plugin.subscribe('sendpay_success')
+def on_sendpay_success(plugin, sendpay_success, **kwargs):
+    resolve_probe(plugin, sendpay_success['payment_hash'])
+
+
+@plugin.subscribe('sendpay_failure')
+def on_sendpay_failure(plugin, sendpay_failure, **kwargs):
+    resolve_probe(plugin, sendpay_failure['data']['payment_hash'], sendpay_failure)
 
 
 def poll_payments(plugin):
-    """Iterate through all probes and complete the finalized ones.
+    """Complete probes whose notification we missed.
+
+    Probes are resolved by the `sendpay_success` and `sendpay_failure`
+    notifications, this only looks at probes that are pending for longer
+    than `PROBE_POLL_AGE` seconds. Each of them is looked up by its
+    `payment_hash`, so the payment history of the node is never listed,
+    only the finished ones cost another call to fetch their error.
     """
-    for probe in plugin.pending_probes:
-        p = plugin.rpc.listsendpays(None, payment_hash=probe['payment_hash'])
-        if p['payments'][0]['status'] == 'pending':
+    with plugin.pending_lock:
+        overdue = set(h for h, p in plugin.pending_probes.items() if p['started_at'] < time() - PROBE_POLL_AGE)
+    if not overdue:
+        return
+
+    for payment_hash in overdue:
+        payments = plugin.rpc.listsendpays(payment_hash=payment_hash)['payments']
+        if any(p['status'] == 'pending' for p in payments):
             continue
+        error = None
+        try:
+            plugin.rpc.waitsendpay(payment_hash, timeout=0)
+        except RpcError as e:
+            error = e.error
+        resolve_probe(plugin, payment_hash, error)
 
-        plugin.pending_probes.remove(probe)
-        cb = probe['callback']
-        del probe['callback']
-        cb(**probe)
 
 def clear_temporary_exclusion(plugin):
-    timed_out = [k for k, v in temporary_exclusions.items() if v < time()]
-    for k in timed_out:
-        del temporary_exclusions[k]
-
+    timed_out = plugin.exclusions.expire()
     print("Removed {}/{} temporary exclusions.".format(
-        len(timed_out), len(temporary_exclusions))
+        timed_out, plugin.exclusions.counts()[1])
     )
 
 
@@ -236,7 +529,7 @@ def schedule(plugin):
     next_runs = [
         (time() + 300, clear_temporary_exclusion, 300),
         (time() + plugin.probe_interval, start_probe, plugin.probe_interval),
-        (time() + 1, poll_payments, 1),
+        (time() + PROBE_POLL_AGE, poll_payments, PROBE_POLL_AGE),
     ]
     heapq.heapify(next_runs)
 
@@ -245,8 +538,11 @@ def schedule(plugin):
         t = n[0] - time()
         if t > 0:
             sleep(t)
-        # Call the function
-        n[1](plugin)
+        # Call the function, an error must not stop the scheduler
+        try:
+            n[1](plugin)
+        except Exception as e:
+            plugin.log("{} failed: {}".format(n[1].__name__, e), level='warn')
 
         # Schedule the next run
         heapq.heappush(next_runs, (time() + n[2], n[1], n[2]))
@@ -254,34 +550,59 @@ def schedule(plugin):
 
 @plugin.init()
 def init(configuration, options, plugin):
-    plugin.probe_interval = int(options['probe-interval'])
+    plugin.probe_interval = float(options['probe-interval'])
+    plugin.probe_parallel = int(options['probe-parallel'])
     plugin.probe_exclusion_duration = int(options['probe-exclusion-duration'])
 
-    db_filename = 'sqlite:///' + os.path.join(
+    plugin.store = ProbeStore(os.path.join(
         configuration['lightning-dir'],
         'probes.db'
+    ), plugin.log)
+    plugin.probe_strategy = options['probe-strategy']
+    if plugin.probe_strategy not in STRATEGIES:
+        raise ValueError("probe-strategy must be one of {}".format(', '.join(STRATEGIES)))
+    plugin.destinations = DestinationIndex(plugin.rpc)
+    plugin.destinations.load(plugin.store.last_probed())
+    plugin.liquidity = LiquidityStore(os.path.join(configuration['lightning-dir'], 'liquidity.sqlite3'))
+    plugin.liquidity.prune()
+    plugin.exclusions = ExclusionSet(
+        os.path.join(configuration['lightning-dir'], 'probes.db'),
+        int(options['probe-exclusion-capacity'])
     )
+    # Probes that are still pending, by payment_hash.
+    plugin.pending_probes = {}
+    plugin.pending_lock = threading.Lock()
+    # Scheduled probes that wait for one in flight to be resolved.
+    plugin.probes_due = 0
 
-    engine = create_engine(db_filename, echo=True)
-    Base.metadata.create_all(engine)
-    plugin.Session = sessionmaker()
-    plugin.Session.configure(bind=engine)
     t = threading.Thread(target=schedule, args=[plugin])
     t.daemon = True
     t.start()
 
-    # Probes that are still pending and need to be checked against.
-    plugin.pending_probes = []
-
 
 plugin.add_option(
     'probe-interval',
     '3600',
     'How many seconds should we wait between probes?'
 )
+plugin.add_option(
+    'probe-strategy',
+    'random',
+    'How to pick probe destinations: random, capacity, stale or coverage'
+)
+plugin.add_option(
+    'probe-parallel',
+    '1',
+    'How many probes may be in flight at the same time?'
+)
 plugin.add_option(
     'probe-exclusion-duration',
     '1800',
     'How many seconds should temporarily failed channels be excluded?'
 )
+plugin.add_option(
+    'probe-exclusion-capacity',
+    '10000',
+    'How many channels may be excluded, the least recent are dropped first'
+)
 plugin.run()
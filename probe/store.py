@@ -0,0 +1,177 @@
+"""Storage of probe results in `probes.db`.
+
+Finished probes are handed to a single writer thread, which inserts them in
+batches, so probing never waits for the disk. The `probes` table keeps the
+columns it always had, the hops of every probe route are in `probe_hops` so
+statistics per channel do not have to split the `route` strings.
+"""
+from datetime import datetime
+from itertools import count
+import queue
+import sqlite3
+import threading
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS probes (
+        id INTEGER PRIMARY KEY,
+        destination VARCHAR,
+        route VARCHAR,
+        error VARCHAR,
+        erring_channel VARCHAR,
+        failcode INTEGER,
+        payment_hash VARCHAR,
+        started_at DATETIME,
+        finished_at DATETIME
+    )""",
+    """CREATE TABLE IF NOT EXISTS probe_hops (
+        probe_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        channel VARCHAR NOT NULL,
+        direction INTEGER,
+        node_id VARCHAR,
+        PRIMARY KEY (probe_id, position)
+    )""",
+    "CREATE INDEX IF NOT EXISTS probes_destination ON probes (destination)",
+    "CREATE INDEX IF NOT EXISTS probes_erring_channel ON probes (erring_channel)",
+    "CREATE INDEX IF NOT EXISTS probes_failcode ON probes (failcode)",
+    "CREATE INDEX IF NOT EXISTS probes_started_at ON probes (started_at)",
+    "CREATE INDEX IF NOT EXISTS probe_hops_channel ON probe_hops (channel)",
+]
+
+# Failcode of a probe that reached its destination.
+SUCCESS_FAILCODE = 16399
+
+# At most this many probes go into one transaction.
+BATCH_SIZE = 500
+
+
+def timestamp(t):
+    """A unix timestamp as stored in the `started_at` and `finished_at` columns."""
+    return str(datetime.fromtimestamp(t)) if t is not None else None
+
+
+class ProbeStore(object):
+
+    def __init__(self, path, log=None):
+        # stdout is the channel to lightningd, errors go to `log`, e.g. `plugin.log`
+        self.path = path
+        self.log = log
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            db.execute(statement)
+        db.commit()
+        self.ids = count((db.execute("SELECT MAX(id) FROM probes").fetchone()[0] or 0) + 1)
+        db.close()
+
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.reader = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        t = threading.Thread(target=self.writer)
+        t.daemon = True
+        t.start()
+
+    def new_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    def add(self, probe):
+        """Queue a finished probe for writing.
+
+        `probe` is the dict of `Probe.jsdict()` with an `id` from `new_id()`,
+        plus the `hops` of its route, its `payment_hash` and `error`.
+        """
+        self.queue.put(probe)
+
+    def flush(self):
+        """Wait until all queued probes are written."""
+        self.queue.join()
+
+    def writer(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT INTO probes (id, destination, route, error, erring_channel, failcode, "
+                        "payment_hash, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(p['id'], p['destination'], p['route'], p.get('error'), p['erring_channel'],
+                          p['failcode'], p.get('payment_hash'), p['started_at'], p['finished_at']) for p in batch])
+                    db.executemany(
+                        "INSERT INTO probe_hops (probe_id, position, channel, direction, node_id) VALUES (?, ?, ?, ?, ?)",
+                        [(p['id'], i, h['channel'], h.get('direction'), h.get('id'))
+                         for p in batch for i, h in enumerate(p.get('hops') or [])])
+            except sqlite3.Error as e:
+                if self.log is not None:
+                    self.log("Could not store {} probes: {}".format(len(batch), e), level='warn')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _query(self, sql, params):
+        self.flush()
+        with self.lock:
+            return self.reader.execute(sql, params).fetchall()
+
+    def last_probed(self):
+        """When a probe route last went through every channel.
+
+        The hops after the `erring_channel` of a probe were never reached.
+        """
+        rows = self._query("SELECT h.channel, MAX(p.started_at) FROM probe_hops h "
+                           "JOIN probes p ON p.id = h.probe_id "
+                           "WHERE h.position <= COALESCE((SELECT MIN(e.position) FROM probe_hops e "
+                           "WHERE e.probe_id = p.id AND e.channel = p.erring_channel), h.position) "
+                           "GROUP BY h.channel", [])
+        return dict(rows)
+
+    def channels(self, start, end, channel=None, limit=100):
+        """Probes through every channel and how often it was the one failing.
+
+        Probes that reached their destination report the last hop as
+        `erring_channel`, they never count as its failures.
+        """
+        where, params = "p.started_at >= ? AND p.started_at < ?", [timestamp(start), timestamp(end)]
+        if channel is not None:
+            where += " AND h.channel = ?"
+            params.append(channel)
+        rows = self._query(
+            "SELECT h.channel, COUNT(*), SUM(p.erring_channel = h.channel AND p.failcode != ?) AS failures, "
+            "SUM(p.failcode = ?) "
+            "FROM probe_hops h JOIN probes p ON p.id = h.probe_id "
+            "WHERE " + where + " GROUP BY h.channel "
+            "ORDER BY failures * 1.0 / COUNT(*) DESC, COUNT(*) DESC LIMIT ?",
+            [SUCCESS_FAILCODE, SUCCESS_FAILCODE] + params + [limit])
+        return [{
+            'channel': c,
+            'probes': n,
+            'failures': failures,
+            'successes': successes,
+            'failure_rate': failures / n,
+        } for c, n, failures, successes in rows]
+
+    def buckets(self, start, end, bucket=3600, destination=None):
+        """Probes started and the share that reached their destination, per `bucket` seconds."""
+        where, params = "started_at >= ? AND started_at < ?", [timestamp(start), timestamp(end)]
+        if destination is not None:
+            where += " AND destination = ?"
+            params.append(destination)
+        rows = self._query(
+            "SELECT CAST(strftime('%s', started_at) AS INTEGER) / ? * ? AS bucket, COUNT(*), "
+            "SUM(failcode = ?), SUM(failcode = -1) "
+            "FROM probes WHERE " + where + " GROUP BY bucket ORDER BY bucket",
+            [bucket, bucket, SUCCESS_FAILCODE] + params)
+        return [{
+            'start': str(datetime.utcfromtimestamp(b)),
+            'probes': n,
+            'successes': successes,
+            'no_route': no_route,
+            'success_rate': successes / n,
+        } for b, n, successes, no_route in rows]
@@ -0,0 +1,15 @@
+from destinations import DestinationIndex
+
+
+def route(*channels):
+    return [{'channel': c, 'direction': 0} for c in channels]
+
+
+def test_observe_stops_at_erring_hop():
+    index = DestinationIndex(rpc=None)
+    index.observe(route('1x1x0', '2x1x0', '3x1x0'), erring_index=1)
+    assert sorted(index.observed) == ['1x1x0', '2x1x0']
+    # a probe rejected by its destination went through every hop
+    index.observe(route('4x1x0', '5x1x0'), erring_index=2)
+    index.observe(route('6x1x0'))
+    assert sorted(index.observed) == ['1x1x0', '2x1x0', '4x1x0', '5x1x0', '6x1x0']
@@ -0,0 +1,57 @@
+from exclusions import ExclusionSet
+import os
+import tempfile
+import time
+
+
+def db_path():
+    return os.path.join(tempfile.mkdtemp(), 'probes.db')
+
+
+def test_temporary_exclusions_expire():
+    exclusions = ExclusionSet(db_path())
+    exclusions.add('1x1x0/0', ttl=-1)
+    exclusions.add('2x1x0/1', ttl=3600)
+    exclusions.add('3x1x0/0')
+    assert '1x1x0/0' not in exclusions
+    assert exclusions.expire() == 1
+    assert sorted(exclusions.list()) == ['2x1x0/1', '3x1x0/0']
+    assert exclusions.counts() == (1, 1)
+
+
+def test_adding_again_refreshes():
+    exclusions = ExclusionSet(db_path())
+    exclusions.add('1x1x0/0', ttl=-1)
+    exclusions.add('1x1x0/0', ttl=3600)
+    # the stale heap entry of the first add does not expire the refreshed one
+    assert exclusions.expire() == 0
+    assert '1x1x0/0' in exclusions
+    # a permanent exclusion stays permanent
+    exclusions.add('2x1x0/0')
+    exclusions.add('2x1x0/0', ttl=-1)
+    assert exclusions.expire() == 0
+    assert exclusions.counts() == (1, 1)
+
+
+def test_capacity_evicts_least_recent():
+    exclusions = ExclusionSet(db_path(), capacity=2)
+    exclusions.add('1x1x0/0')
+    exclusions.add('2x1x0/0', ttl=3600)
+    exclusions.add('1x1x0/0')  # refreshed, so 2x1x0/0 is the least recent now
+    exclusions.add('3x1x0/0')
+    assert exclusions.list() == ['1x1x0/0', '3x1x0/0']
+    assert len(exclusions) == 2
+
+
+def test_reload_from_disk():
+    path = db_path()
+    exclusions = ExclusionSet(path, capacity=3)
+    exclusions.add('1x1x0/0')
+    exclusions.add('2x1x0/0', ttl=3600)
+    exclusions.add('3x1x0/0', ttl=0.1)
+    exclusions.add('4x1x0/0')  # evicts 1x1x0/0, also on disk
+    time.sleep(0.2)
+    reloaded = ExclusionSet(path, capacity=10)
+    # the expired one is dropped on load, the evicted one is gone
+    assert reloaded.list() == ['2x1x0/0', '4x1x0/0']
+    assert reloaded.counts() == (1, 1)
@@ -0,0 +1,50 @@
+from store import ProbeStore, SUCCESS_FAILCODE, timestamp
+import os
+import tempfile
+import time
+
+
+def add_probe(store, route, erring_channel, failcode):
+    started_at = time.time()
+    store.add({
+        'id': store.new_id(),
+        'destination': 'D',
+        'route': ','.join(route),
+        'erring_channel': erring_channel,
+        'failcode': failcode,
+        'started_at': timestamp(started_at),
+        'finished_at': timestamp(started_at),
+        'hops': [{'channel': c, 'direction': 0, 'id': 'N%d' % i} for i, c in enumerate(route)],
+    })
+
+
+def test_channels_failures():
+    store = ProbeStore(os.path.join(tempfile.mkdtemp(), 'probes.db'))
+    # successful probes name their last hop as erring channel
+    for _ in range(3):
+        add_probe(store, ['1x1x0', '2x1x0'], '2x1x0', SUCCESS_FAILCODE)
+    add_probe(store, ['1x1x0', '3x1x0'], '1x1x0', 4103)
+    channels = store.channels(time.time() - 60, time.time() + 60)
+    assert [c['channel'] for c in channels] == ['1x1x0', '2x1x0', '3x1x0']
+    assert channels[0]['failures'] == 1 and channels[0]['probes'] == 4 and channels[0]['successes'] == 3
+    assert channels[1]['failures'] == 0 and channels[1]['successes'] == 3
+
+
+def test_write_errors_are_logged():
+    logs = []
+    store = ProbeStore(os.path.join(tempfile.mkdtemp(), 'probes.db'), lambda msg, level: logs.append((level, msg)))
+    add_probe(store, ['1x1x0'], '1x1x0', SUCCESS_FAILCODE)
+    store.flush()
+    # the same id again violates the primary key
+    store.ids = iter([1])
+    add_probe(store, ['1x1x0'], '1x1x0', SUCCESS_FAILCODE)
+    store.flush()
+    assert logs and logs[0][0] == 'warn' and 'Could not store 1 probes' in logs[0][1]
+
+
+def test_last_probed_stops_at_erring_channel():
+    store = ProbeStore(os.path.join(tempfile.mkdtemp(), 'probes.db'))
+    add_probe(store, ['1x1x0', '2x1x0', '3x1x0'], '2x1x0', 4103)
+    add_probe(store, ['4x1x0', '5x1x0'], '5x1x0', SUCCESS_FAILCODE)
+    add_probe(store, ['6x1x0'], None, None)
+    assert sorted(store.last_probed()) == ['1x1x0', '2x1x0', '4x1x0', '5x1x0', '6x1x0']
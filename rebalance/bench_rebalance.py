@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Offline benchmark for the rebalance plugin.
+
+This replays rebalance scenarios against a fake `plugin.rpc` that is backed
+by a randomly generated network graph, so route search and caching changes
+can be compared without a running lightningd. Payments succeed or fail
+depending on the simulated liquidity of every channel on the route.
+
+For every graph size it reports the success rate, latency percentiles of a
+whole rebalance and the number of RPC calls a rebalance issued, plus timings
+of `setup_routing_fees` and the local route search alone:
+
+```bash
+python3 bench_rebalance.py --channels 1000 10000 50000 --runs 100
+```
+"""
+from graph import ChannelGraph
+from history import HistoryStore
+from liquidity import LiquidityStore
+from pyln.client import Millisatoshi, RpcError
+import argparse
+import os
+import random
+import rebalance
+import tempfile
+import time
+
+
+class FakeRpc(object):
+    """Answers the RPC calls rebalance uses from a generated graph."""
+
+    def __init__(self, node_id, channels, own, latency=0):
+        self.node_id = node_id
+        self.channels = channels
+        self.own = own
+        self.latency = latency
+        self.calls = {}
+        self.by_scid = {}
+        self.by_source = {}
+        for c in channels:
+            self.by_scid.setdefault(c['short_channel_id'], []).append(c)
+            self.by_source.setdefault(c['source'], []).append(c)
+        self.pending = {}
+
+    def _call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def getinfo(self):
+        self._call('getinfo')
+        return {'id': self.node_id}
+
+    def listconfigs(self):
+        self._call('listconfigs')
+        return {'cltv-final': 10}
+
+    def listpeers(self, peer_id=None):
+        self._call('listpeers')
+        return {'peers': [{
+            'id': c['peer_id'],
+            'connected': True,
+            'channels': [{'short_channel_id': c['short_channel_id'], 'state': 'CHANNELD_NORMAL'}],
+        } for c in self.own if peer_id is None or c['peer_id'] == peer_id]}
+
+    def listfunds(self):
+        self._call('listfunds')
+        return {'channels': [{
+            'short_channel_id': c['short_channel_id'],
+            'peer_id': c['peer_id'],
+            'our_amount_msat': Millisatoshi(c['liquidity'][c['direction']]),
+            'amount_msat': Millisatoshi(c['capacity']),
+        } for c in self.own]}
+
+    def listchannels(self, short_channel_id=None, source=None):
+        self._call('listchannels')
+        if short_channel_id is not None:
+            return {'channels': list(self.by_scid.get(short_channel_id, []))}
+        if source is not None:
+            return {'channels': list(self.by_source.get(source, []))}
+        return {'channels': list(self.channels)}
+
+    def invoice(self, msatoshi, label, description, expiry=None):
+        self._call('invoice')
+        return {'payment_hash': '%064x' % random.getrandbits(256), 'payment_secret': '%064x' % random.getrandbits(256)}
+
+    def delinvoice(self, label, status):
+        self._call('delinvoice')
+
+    def sendpay(self, route, payment_hash, *args, **kwargs):
+        self._call('sendpay')
+        self.pending[payment_hash] = route
+
+    def waitsendpay(self, payment_hash, timeout=None, *args, **kwargs):
+        self._call('waitsendpay')
+        route = self.pending.pop(payment_hash)
+        for i, hop in enumerate(route):
+            c = next(c for c in self.by_scid[hop['channel']] if c['channel_flags'] == hop['direction'])
+            if c['liquidity'][hop['direction']] < int(hop['msatoshi']):
+                raise RpcError('waitsendpay', {}, {'message': 'WIRE_TEMPORARY_CHANNEL_FAILURE', 'data': {
+                    'erring_index': i,
+                    'erring_channel': hop['channel'],
+                    'erring_direction': hop['direction'],
+                    'failcode': 0x1007,
+                }})
+        for hop in route:
+            c = next(c for c in self.by_scid[hop['channel']] if c['channel_flags'] == hop['direction'])
+            c['liquidity'][hop['direction']] -= int(hop['msatoshi'])
+            c['liquidity'][1 - hop['direction']] += int(hop['msatoshi'])
+        return {'status': 'complete'}
+
+    def call(self, method, params):
+        if method == 'sendpay':
+            return self.sendpay(params['route'], (params['payment_hash'], params['partid']))
+        if method == 'waitsendpay':
+            return self.waitsendpay((params['payment_hash'], params['partid']))
+        raise ValueError("Unsupported method %s" % method)
+
+
+class FakePlugin(object):
+
+    def __init__(self, rpc, lightning_dir):
+        self.rpc = rpc
+        self.graph = ChannelGraph(rpc)
+        self.liquidity = LiquidityStore(os.path.join(lightning_dir, 'liquidity.sqlite3'))
+        self.history = HistoryStore(os.path.join(lightning_dir, 'rebalance.sqlite3'))
+
+    def log(self, message, level='info'):
+        pass
+
+    def get_option(self, name):
+        return {'cltv-final': 10}[name]
+
+
+def node_id(i):
+    return '02%064x' % i
+
+
+def generate_graph(num_channels, own_channels, seed):
+    """Random graph with preferential attachment, so it has hubs like the real network."""
+    rnd = random.Random(seed)
+    num_nodes = max(num_channels // 5, own_channels + 2)
+    me = node_id(0)
+    endpoints = []
+    channels = []
+    own = []
+
+    def add(i, a, b, our_share=None):
+        scid = '%dx%dx0' % (100000 + i, rnd.randint(1, 3000))
+        capacity = rnd.randint(10**5, 10**7) * 1000
+        share = our_share if our_share is not None else rnd.random()
+        # liquidity[d] is what the source of direction d can send
+        first = int(capacity * share)
+        liquidity = [first, capacity - first]
+        for source, destination in ((a, b), (b, a)):
+            direction = 0 if source < destination else 1
+            channels.append({
+                'short_channel_id': scid,
+                'channel_flags': direction,
+                'source': source,
+                'destination': destination,
+                'active': True,
+                'satoshis': capacity // 1000,
+                'amount_msat': Millisatoshi(capacity),
+                'base_fee_millisatoshi': rnd.choice([0, 1, 1000]),
+                'fee_per_millionth': rnd.choice([1, 10, 100, 200, 500, 1000]),
+                'delay': rnd.choice([6, 14, 40, 144]),
+                'liquidity': liquidity,
+            })
+        endpoints.extend([a, b])
+        return scid, capacity, liquidity
+
+    for i in range(own_channels):
+        peer = node_id(i + 1)
+        scid, capacity, liquidity = add(i, me, peer, rnd.choice([0.1, 0.9]))
+        own.append({
+            'short_channel_id': scid,
+            'peer_id': peer,
+            'direction': 0 if me < peer else 1,
+            'capacity': capacity,
+            'liquidity': liquidity,
+        })
+    for i in range(own_channels, num_channels):
+        a = node_id(rnd.randint(1, num_nodes))
+        b = rnd.choice(endpoints) if rnd.random() < 0.8 else node_id(rnd.randint(1, num_nodes))
+        if a == b or me in (a, b):
+            continue
+        add(i, a, b)
+    return me, channels, own
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(num_channels, args):
+    me, channels, own = generate_graph(num_channels, args.own, args.seed)
+    rpc = FakeRpc(me, channels, own, args.latency / 1000.0)
+    plugin = FakePlugin(rpc, tempfile.mkdtemp())
+    rnd = random.Random(args.seed)
+
+    latencies = []
+    succeeded = 0
+    for _ in range(args.runs):
+        out_ch = max(own, key=lambda c: c['liquidity'][c['direction']] + rnd.random())
+        in_ch = min(own, key=lambda c: c['liquidity'][c['direction']] + rnd.random())
+        payload = {
+            "outgoing_scid": out_ch['short_channel_id'],
+            "incoming_scid": in_ch['short_channel_id'],
+            "msatoshi": Millisatoshi(int(min(out_ch['capacity'], in_ch['capacity']) * args.amount / 100)),
+            "maxfeepercent": args.maxfeepercent,
+            "retry_for": args.retry_for,
+            "exemptfee": Millisatoshi(5000),
+            "parts": args.parts,
+        }
+        start = time.time()
+        try:
+            rebalance.execute(plugin, rebalance.get_state(plugin), payload)
+            succeeded += 1
+        except RpcError:
+            pass
+        latencies.append((time.time() - start) * 1000)
+    calls = sum(rpc.calls.values())
+    rpc.calls = {}
+
+    # the two building blocks on their own, with a warm cache
+    route = None
+    start = time.time()
+    for _ in range(args.runs):
+        routes = plugin.graph.find_routes(node_id(1), node_id(2), 10**7, 10**7 + 10**5, count=rebalance.ROUTE_CANDIDATES)
+        route = routes[0] if routes else route
+    search_ms = (time.time() - start) * 1000 / args.runs
+    fees_us = 0.0
+    if route is not None:
+        start = time.time()
+        for _ in range(args.runs):
+            rebalance.setup_routing_fees(plugin, route, Millisatoshi(10**7))
+        fees_us = (time.time() - start) * 10**6 / args.runs
+
+    print("%8d  %5d  %6.1f%%  %8.1f  %8.1f  %8.1f  %8.1f  %10.1f  %9.1f" % (
+        num_channels, args.runs, 100.0 * succeeded / args.runs,
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+        float(calls) / args.runs,
+        search_ms, fees_us))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_rebalance.py")
+    parser.add_argument("--channels", type=int, nargs='+', default=[1000, 10000, 50000],
+                        help="sizes of the generated graphs")
+    parser.add_argument("--own", type=int, default=20, help="number of our own channels")
+    parser.add_argument("--runs", type=int, default=50, help="rebalances per graph")
+    parser.add_argument("--amount", type=float, default=5, help="percent of the smaller capacity to rebalance")
+    parser.add_argument("--parts", type=int, default=1, help="split rebalances into this many parts")
+    parser.add_argument("--maxfeepercent", type=float, default=0.5)
+    parser.add_argument("--retry-for", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0, help="simulated milliseconds per RPC call")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("channels   runs  success    p50 ms    p90 ms    p99 ms  rpc/run  search ms  fees us")
+    for num_channels in args.channels:
+        bench(num_channels, args)
+
+
+if __name__ == '__main__':
+    main()
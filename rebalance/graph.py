@@ -0,0 +1,256 @@
+from pyln.client import Millisatoshi
+import heapq
+import threading
+import time
+
+
+def forward_fee(policy, msatoshi):
+    # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
+    return policy['base'] + (msatoshi * policy['ppm'] + 10**6 - 1) // 10**6  # integer math trick to round up
+
+
+class ChannelGraph(object):
+    """Process-wide cache of channel policies keyed by `scid/direction`.
+
+    The whole table is filled from a single `listchannels` call and reused
+    until it gets older than `max_age` seconds. Single channels are
+    refetched when a payment attempt tells us their gossip has changed.
+
+    The same table doubles as the public network graph, so routes can be
+    searched locally instead of asking `getroute` for every attempt.
+    """
+
+    def __init__(self, rpc, max_age=600, max_hops=20, max_delay=2016):
+        self.rpc = rpc
+        self.max_age = max_age
+        self.max_hops = max_hops
+        self.max_delay = max_delay
+        self.channels = {}
+        self.incoming = {}
+        self.outgoing = {}
+        self.updated_at = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(scid, direction):
+        return "%s/%d" % (scid, int(direction))
+
+    @staticmethod
+    def _policy(ch):
+        if 'amount_msat' in ch:
+            capacity = int(Millisatoshi(ch['amount_msat']))
+        else:
+            capacity = int(ch['satoshis']) * 1000
+        htlc_max = ch.get('htlc_maximum_msat')
+        return {
+            'scid': ch['short_channel_id'],
+            'direction': int(ch['channel_flags']) & 1,
+            'source': ch['source'],
+            'destination': ch['destination'],
+            'active': ch.get('active', True),
+            'capacity': capacity,
+            'htlc_min': int(Millisatoshi(ch.get('htlc_minimum_msat', 0))),
+            'htlc_max': int(Millisatoshi(htlc_max)) if htlc_max is not None else capacity,
+            'base': int(ch['base_fee_millisatoshi']),
+            'ppm': int(ch['fee_per_millionth']),
+            'delay': int(ch['delay']),
+        }
+
+    def _add(self, ch, channels, incoming, outgoing):
+        policy = self._policy(ch)
+        key = self.key(policy['scid'], policy['direction'])
+        channels[key] = policy
+        incoming.setdefault(policy['destination'], set()).add(key)
+        outgoing.setdefault(policy['source'], set()).add(key)
+
+    def refresh(self):
+        # build new tables aside, so concurrent readers never see partial ones
+        channels, incoming, outgoing = {}, {}, {}
+        for ch in self.rpc.listchannels().get('channels'):
+            self._add(ch, channels, incoming, outgoing)
+        with self.lock:
+            self.channels, self.incoming, self.outgoing = channels, incoming, outgoing
+            self.updated_at = time.time()
+
+    def is_stale(self):
+        return time.time() - self.updated_at > self.max_age
+
+    def _update(self, scid):
+        """Replace both directions of `scid` with a fresh `listchannels`."""
+        found = self.rpc.listchannels(scid).get('channels')
+        with self.lock:
+            channels, incoming, outgoing = dict(self.channels), dict(self.incoming), dict(self.outgoing)
+            for direction in (0, 1):
+                old = channels.pop(self.key(scid, direction), None)
+                if old is not None:
+                    incoming[old['destination']] = incoming[old['destination']] - {self.key(scid, direction)}
+                    outgoing[old['source']] = outgoing[old['source']] - {self.key(scid, direction)}
+            for ch in found:
+                incoming[ch['destination']] = set(incoming.get(ch['destination'], ()))
+                outgoing[ch['source']] = set(outgoing.get(ch['source'], ()))
+                self._add(ch, channels, incoming, outgoing)
+            self.channels, self.incoming, self.outgoing = channels, incoming, outgoing
+
+    def invalidate(self, scid):
+        """Refetch both directions of `scid`, e.g. after it reported an error.
+
+        The channel stays in the graph with its new policy, or leaves it if
+        it is gone, instead of missing from route searches until the next
+        refresh.
+        """
+        self._update(scid)
+
+    def get(self, scid, direction):
+        if self.is_stale():
+            self.refresh()
+        key = self.key(scid, direction)
+        policy = self.channels.get(key)
+        if policy is not None:
+            return policy
+        # unknown channel, fetch just this one
+        self._update(scid)
+        policy = self.channels.get(key)
+        if policy is None:
+            raise KeyError("No gossip for channel %s" % key)
+        return policy
+
+    def _usable(self, policy, msatoshi):
+        return (policy['active']
+                and policy['htlc_min'] <= msatoshi <= policy['htlc_max']
+                and msatoshi <= policy['capacity'])
+
+    def _fee_bounds(self, graph, source, msatoshi, excludes):
+        """Least fees from `source` to every node it can reach.
+
+        Every channel is weighted with its fee for `msatoshi`, the least
+        amount any hop forwards, so these are lower bounds of what the rest
+        of a path back to `source` costs. They guide `_search` to `source`.
+        """
+        channels, _, outgoing = graph
+        bounds = {source: 0}
+        heap = [(0, source)]
+        while heap:
+            fees, node = heapq.heappop(heap)
+            if fees > bounds[node]:
+                continue
+            for key in outgoing.get(node, ()):
+                policy = channels.get(key)
+                if policy is None or key in excludes or not policy['active']:
+                    continue
+                total = fees + forward_fee(policy, msatoshi)
+                if total < bounds.get(policy['destination'], total + 1):
+                    bounds[policy['destination']] = total
+                    heapq.heappush(heap, (total, policy['destination']))
+        return bounds
+
+    def _search(self, graph, source, target, msatoshi, max_amount, excludes, banned, max_hops, max_delay, bounds):
+        """Cheapest path from `source` to `target` delivering `msatoshi`.
+
+        The search runs backwards from `target`, so every hop is weighted
+        with the exact amount it has to forward. Nodes are visited in the
+        order of their amount plus their fee bound from `_fee_bounds`, so
+        the search heads for `source` and stops as soon as it gets there.
+        Paths are limited to `max_hops` channels whose delays sum up to at
+        most `max_delay`. Returns the amount that has to arrive at `source`
+        (including the fee `source` charges itself) together with the list
+        of channel keys, or `None`.
+        """
+        channels, incoming, _ = graph
+        if target not in bounds or msatoshi + bounds[target] > max_amount:
+            return None
+        best = {target: msatoshi}
+        prev = {}
+        heap = [(msatoshi + bounds[target], msatoshi, 0, 0, target)]
+        while heap:
+            _, amount, hops, delay, node = heapq.heappop(heap)
+            if node == source:
+                path = []
+                while node != target:
+                    key, node = prev[node]
+                    path.append(key)
+                return amount, path
+            if amount > best.get(node, amount) or hops >= max_hops:
+                continue
+            for key in incoming.get(node, ()):
+                policy = channels.get(key)
+                if policy is None or key in excludes or policy['source'] in banned:
+                    continue
+                if not self._usable(policy, amount) or delay + policy['delay'] > max_delay:
+                    continue
+                bound = bounds.get(policy['source'])
+                if bound is None:
+                    continue  # not reachable from `source`
+                src_amount = amount + forward_fee(policy, amount)
+                if src_amount + bound > max_amount or src_amount >= best.get(policy['source'], src_amount + 1):
+                    continue
+                best[policy['source']] = src_amount
+                prev[policy['source']] = (key, node)
+                heapq.heappush(heap, (src_amount + bound, src_amount, hops + 1, delay + policy['delay'], policy['source']))
+        return None
+
+    def _amount_at(self, channels, path, msatoshi):
+        for key in reversed(path):
+            msatoshi += forward_fee(channels[key], msatoshi)
+        return msatoshi
+
+    def find_routes(self, source, destination, msatoshi, max_amount, excludes=(), count=1, extra_hops=0, extra_delay=0):
+        """Return up to `count` cheapest routes, cheapest first.
+
+        This is Yen's k-shortest-paths algorithm, mirrored so that spur paths
+        are searched backwards like in `_search`. Routes whose cost exceeds
+        `max_amount` at `source` are never considered. The caller adds
+        `extra_hops` hops with `extra_delay` blocks of delay around the
+        routes, which count against `max_hops` and `max_delay`. Each route is
+        a list of hops in the format `getroute` uses, without amounts and
+        delays.
+        """
+        if self.is_stale():
+            self.refresh()
+        # tables are replaced, never mutated, so this is a consistent snapshot
+        graph = self.channels, self.incoming, self.outgoing
+        channels = graph[0]
+        excludes = set(excludes)
+        max_hops = self.max_hops - extra_hops
+        max_delay = self.max_delay - extra_delay
+        bounds = self._fee_bounds(graph, source, msatoshi, excludes)
+        found = self._search(graph, source, destination, msatoshi, max_amount, excludes, set(), max_hops, max_delay, bounds)
+        if found is None:
+            return []
+        paths = [found[1]]
+        candidates = []
+        while len(paths) < count:
+            last = paths[-1]
+            # the root is the part of the last path after the spur node,
+            # an empty root spurs at the destination itself
+            for i in range(1, len(last) + 1):
+                root = last[i:]
+                if root:
+                    spur_node = channels[root[0]]['source']
+                else:
+                    spur_node = destination
+                removed = set(excludes)
+                for p in paths:
+                    if len(p) > len(root) and p[len(p) - len(root):] == root:
+                        removed.add(p[len(p) - len(root) - 1])
+                banned = set(channels[k]['destination'] for k in root)
+                # a spur costing more than the candidates still needed is of no use
+                bound = max_amount
+                needed = count - len(paths)
+                if len(candidates) >= needed:
+                    bound = min(bound, heapq.nsmallest(needed, candidates)[-1][0])
+                spur = self._search(graph, source, spur_node, self._amount_at(channels, root, msatoshi),
+                                    bound, removed, banned, max_hops - len(root),
+                                    max_delay - sum(channels[k]['delay'] for k in root), bounds)
+                if spur is None:
+                    continue
+                path = spur[1] + root
+                if path in paths or any(path == c[1] for c in candidates):
+                    continue
+                heapq.heappush(candidates, (spur[0], path))
+            if not candidates:
+                break
+            paths.append(heapq.heappop(candidates)[1])
+
+        return [[{'id': channels[k]['destination'],
+                  'channel': channels[k]['scid'],
+                  'direction': channels[k]['direction']} for k in p] for p in paths]
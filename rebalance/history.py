@@ -0,0 +1,123 @@
+"""Append-only ledger of rebalances and their payment attempts.
+
+Every finished rebalance job is stored with its channel pair, amount, fee,
+duration and outcome, every payment attempt with its route length, fee and
+failure reason. Rows are never updated, so the ledger can be used to compute
+what rebalancing a channel did really cost.
+"""
+import sqlite3
+import threading
+import time
+
+
+class HistoryStore(object):
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS rebalances (
+            id INTEGER PRIMARY KEY,
+            payment_hash TEXT,
+            outgoing_scid TEXT NOT NULL,
+            incoming_scid TEXT NOT NULL,
+            msatoshi INTEGER,
+            fee_msat INTEGER,
+            hops INTEGER,
+            parts INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            started_at REAL NOT NULL,
+            finished_at REAL NOT NULL
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS attempts (
+            id INTEGER PRIMARY KEY,
+            payment_hash TEXT NOT NULL,
+            msatoshi INTEGER NOT NULL,
+            fee_msat INTEGER NOT NULL,
+            hops INTEGER NOT NULL,
+            erring_channel TEXT,
+            error TEXT,
+            started_at REAL NOT NULL,
+            finished_at REAL NOT NULL
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rebalances_started_at ON rebalances (started_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rebalances_outgoing ON rebalances (outgoing_scid, started_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rebalances_incoming ON rebalances (incoming_scid, started_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS attempts_payment_hash ON attempts (payment_hash)")
+        self.db.commit()
+
+    def record_attempt(self, payment_hash, route, msatoshi, started_at, error=None):
+        """One payment attempt over `route`, `error` is the RpcError if it failed."""
+        erring_channel, message = None, None
+        if error is not None:
+            data = error.error.get('data', {})
+            if data.get('erring_channel') is not None:
+                erring_channel = "%s/%s" % (data['erring_channel'], data.get('erring_direction'))
+            message = data.get('failcodename', error.error.get('message', str(error)))
+        with self.lock:
+            self.db.execute("INSERT INTO attempts (payment_hash, msatoshi, fee_msat, hops, erring_channel, error, "
+                            "started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (payment_hash, int(msatoshi), int(route[0]['msatoshi']) - int(msatoshi), len(route),
+                             erring_channel, message, started_at, time.time()))
+            self.db.commit()
+
+    def record_rebalance(self, payload, status, started_at, result=None, error=None):
+        """A finished rebalance, `result` is what `execute` returned on success."""
+        result = result or {}
+        msatoshi = payload.get('msatoshi')
+        with self.lock:
+            self.db.execute("INSERT INTO rebalances (payment_hash, outgoing_scid, incoming_scid, msatoshi, fee_msat, "
+                            "hops, parts, status, error, started_at, finished_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (payload.get('payment_hash'), payload['outgoing_scid'], payload['incoming_scid'],
+                             int(msatoshi) if msatoshi is not None else None,
+                             int(result['fee_msat']) if 'fee_msat' in result else None,
+                             result.get('hops'), payload.get('parts', 1), status, error, started_at, time.time()))
+            self.db.commit()
+
+    def _where(self, start, end, scid):
+        clauses, params = ["started_at >= ?", "started_at < ?"], [start, end]
+        if scid is not None:
+            clauses.append("(outgoing_scid = ? OR incoming_scid = ?)")
+            params += [scid, scid]
+        return " AND ".join(clauses), params
+
+    def rebalances(self, start=0, end=None, scid=None, limit=100):
+        """The latest rebalances started within `[start, end)`, newest first."""
+        where, params = self._where(start, end if end is not None else time.time() + 1, scid)
+        with self.lock:
+            rows = self.db.execute("SELECT payment_hash, outgoing_scid, incoming_scid, msatoshi, fee_msat, hops, parts, "
+                                   "status, error, started_at, finished_at, "
+                                   "(SELECT COUNT(*) FROM attempts a WHERE a.payment_hash = r.payment_hash) "
+                                   "FROM rebalances r WHERE " + where + " ORDER BY started_at DESC LIMIT ?",
+                                   params + [limit]).fetchall()
+        keys = ['payment_hash', 'outgoing_scid', 'incoming_scid', 'msatoshi', 'fee_msat', 'hops', 'parts',
+                'status', 'error', 'started_at', 'finished_at', 'attempts']
+        return [dict(zip(keys, row)) for row in rows]
+
+    def channels(self, start=0, end=None, scid=None):
+        """Totals of all rebalances within `[start, end)` per channel and direction."""
+        where, params = self._where(start, end if end is not None else time.time() + 1, scid)
+        totals = {}
+        with self.lock:
+            for side in ('outgoing', 'incoming'):
+                rows = self.db.execute(
+                    "SELECT %s_scid, COUNT(*), SUM(status = 'success'), "
+                    "SUM(CASE WHEN status = 'success' THEN msatoshi ELSE 0 END), "
+                    "SUM(CASE WHEN status = 'success' THEN fee_msat ELSE 0 END), "
+                    "SUM(finished_at - started_at) "
+                    "FROM rebalances WHERE %s GROUP BY %s_scid" % (side, where, side), params).fetchall()
+                for channel, count, succeeded, msatoshi, fee, duration in rows:
+                    if scid is not None and channel != scid:
+                        continue
+                    totals.setdefault(channel, {'scid': channel})[side] = {
+                        'rebalances': count,
+                        'succeeded': succeeded,
+                        'msatoshi': msatoshi,
+                        'fee_msat': fee,
+                        # fee paid per million msat moved, what rebalancing this channel costs
+                        'fee_ppm': fee * 10**6 // msatoshi if msatoshi else None,
+                        'duration': duration,
+                    }
+        return sorted(totals.values(), key=lambda c: c['scid'])
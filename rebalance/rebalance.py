@@ -1,29 +1,73 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fees import policy_arrays, route_amounts
+from graph import ChannelGraph, forward_fee
+from history import HistoryStore
+from liquidity import LiquidityStore
 from pyln.client import Plugin, Millisatoshi, RpcError
+import os
+import threading
 import time
 import uuid
 
 plugin = Plugin()
 
+# number of candidate routes computed per local route search
+ROUTE_CANDIDATES = 10
+
+# seconds finished jobs are kept for rebalance-status
+JOB_KEEP = 24 * 3600
+
+# seconds after which tracked balances are read again from listfunds
+AUTO_RESYNC = 3600
+
+# minimum seconds between two rounds of automatic rebalances
+AUTO_COOLDOWN = 60
+
+# most seconds a pair of channels whose automatic rebalances keep failing waits,
+# the wait starts at AUTO_COOLDOWN and doubles with every failure
+AUTO_BACKOFF_MAX = 24 * 3600
+
 
 def setup_routing_fees(plugin, route, msatoshi):
-    delay = int(plugin.get_option('cltv-final'))
-    for r in reversed(route):
-        r['msatoshi'] = msatoshi.millisatoshis
-        r['amount_msat'] = msatoshi
-        r['delay'] = delay
-        channels = plugin.rpc.listchannels(r['channel'])
-        ch = next(c for c in channels.get('channels') if c['destination'] == r['id'])
-        fee = Millisatoshi(ch['base_fee_millisatoshi'])
-        # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
-        fee += (msatoshi * ch['fee_per_millionth'] + 10**6 - 1) // 10**6 # integer math trick to round up
-        msatoshi += fee
-        delay += ch['delay']
-
-
-def get_channel(plugin, payload, peer_id, scid, check_state: bool=False):
-    peer = plugin.rpc.listpeers(peer_id).get('peers')[0]
-    channel = next(c for c in peer['channels'] if 'short_channel_id' in c and c['short_channel_id'] == scid)
+    setup_routing_fees_batch(plugin, [route], msatoshi)
+
+
+def setup_routing_fees_batch(plugin, routes, msatoshi):
+    """Set amounts and delays of all hops of many routes in one go."""
+    base, ppm, delay = policy_arrays(routes, lambda r: plugin.graph.get(r['channel'], r['direction']))
+    amounts, delays = route_amounts(base, ppm, delay, int(msatoshi), int(plugin.get_option('cltv-final')))
+    for i, route in enumerate(routes):
+        offset = amounts.shape[1] - len(route)
+        for j, r in enumerate(route):
+            r['msatoshi'] = int(amounts[i, offset + j])
+            r['amount_msat'] = Millisatoshi(r['msatoshi'])
+            r['delay'] = int(delays[i, offset + j])
+
+
+def get_state(plugin):
+    """Fetch our node and channel state once, so it can be shared by many rebalances."""
+    state = {
+        'my_node_id': plugin.rpc.getinfo().get('id'),
+        'peers': {},
+        'funds': {},
+        'excludes': [],
+    }
+    for peer in plugin.rpc.listpeers().get('peers'):
+        for c in peer['channels']:
+            if 'short_channel_id' in c:
+                state['peers'][c['short_channel_id']] = (peer, c)
+    for c in plugin.rpc.listfunds().get('channels'):
+        if 'short_channel_id' in c:
+            state['funds'][c['short_channel_id']] = c
+    # excude all own channels to prevent unwanted shortcuts [out,mid,in]
+    for channel in plugin.rpc.listchannels(source=state['my_node_id'])['channels']:
+        state['excludes'] += [channel['short_channel_id'] + '/0', channel['short_channel_id'] + '/1']
+    return state
+
+
+def get_channel(state, payload, scid, check_state: bool=False):
+    peer, channel = state['peers'][scid]
     if check_state:
         if channel['state'] != "CHANNELD_NORMAL":
             raise RpcError('rebalance', payload, {'message': 'Channel %s not in state CHANNELD_NORMAL, but: %s' % (scid, channel['state']) })
@@ -32,43 +76,131 @@ def get_channel(plugin, payload, peer_id, scid, check_state: bool=False):
     return channel
 
 
-def amounts_from_scid(plugin, scid):
-    channels = plugin.rpc.listfunds().get('channels')
-    channel = next(c for c in channels if 'short_channel_id' in c and c['short_channel_id'] == scid)
+def amounts_from_scid(state, scid):
+    channel = state['funds'][scid]
     our_msat = Millisatoshi(channel['our_amount_msat'])
     total_msat = Millisatoshi(channel['amount_msat'])
     return our_msat, total_msat
 
 
-def peer_from_scid(plugin, short_channel_id, my_node_id, payload):
-    channels = plugin.rpc.listchannels(short_channel_id).get('channels')
-    for ch in channels:
-        if ch['source'] == my_node_id:
-            return ch['destination']
+def peer_from_scid(state, short_channel_id, payload):
+    if short_channel_id in state['peers']:
+        return state['peers'][short_channel_id][0]['id']
     raise RpcError("rebalance", payload, {'message': 'Cannot find peer for channel: ' + short_channel_id})
 
 
-def find_worst_channel(route):
-    if len(route) < 4:
-        return None
-    start_id = 2
-    worst = route[start_id]['channel']
-    worst_val = route[start_id - 1]['msatoshi'] - route[start_id]['msatoshi']
-    for i in range(start_id + 1, len(route) - 1):
-        val = route[i - 1]['msatoshi'] - route[i]['msatoshi']
-        if val > worst_val:
-            worst = route[i]['channel']
-            worst_val = val
-    return worst
+def handle_payment_error(plugin, payload, e, excludes, route):
+    """Exclude the erring channel of a failed attempt, or raise if it is one of ours."""
+    plugin.log("RpcError: " + str(e))
+    erring_channel = e.error.get('data', {}).get('erring_channel')
+    if erring_channel == payload['incoming_scid']:
+        raise RpcError("rebalance", payload, {'message': 'Error with incoming channel'})
+    if erring_channel == payload['outgoing_scid']:
+        raise RpcError("rebalance", payload, {'message': 'Error with outgoing channel'})
+    erring_direction = e.error.get('data', {}).get('erring_direction')
+    if erring_channel is not None and erring_direction is not None:
+        excludes.append(erring_channel + '/' + str(erring_direction))
+        # remember the failure for later rebalances and the other plugins
+        hop = next((h for h in route[1:-1] if h['channel'] == erring_channel), None)
+        if hop is not None:
+            plugin.liquidity.record_failure(excludes[-1], hop['msatoshi'], e.error['data'].get('failcode'))
+    # the error may have carried a channel_update, so refetch its policy
+    if erring_channel is not None:
+        plugin.graph.invalidate(erring_channel)
+
+
+def split_amount(msatoshi, parts):
+    part = int(msatoshi) // parts
+    return [Millisatoshi(part)] * (parts - 1) + [Millisatoshi(int(msatoshi) - part * (parts - 1))]
+
+
+def pay_parts(plugin, payload, invoice, incoming_node_id, route_out, route_in, excludes, start_ts, cancel):
+    """Send the amount as `payload['parts']` concurrent parts of one payment.
+
+    Every part takes its own route and routes of parts in flight never share
+    a channel in the middle. A failed part is sent again over a new route
+    while the others are still pending. Returns the sum of all fees paid.
+    """
+    msatoshi = payload['msatoshi']
+    if 'payment_secret' not in invoice:
+        raise RpcError("rebalance", payload, {'message': 'lightningd does not support multi-part payments'})
+    maxfee = max(int(payload['exemptfee']), int(int(msatoshi) * payload['maxfeepercent'] / 100))
+    in_direction = route_in['direction']
+    todo = split_amount(msatoshi, payload['parts'])
+    inflight = {}
+    fees = Millisatoshi(0)
+    partid = 0
+
+    def remaining():
+        return payload['retry_for'] + start_ts - int(time.time())
+
+    with ThreadPoolExecutor(max_workers=payload['parts']) as executor:
+        while todo or inflight:
+            check_cancelled(payload, cancel)
+            busy = set(excludes)
+            for _, _, route, _ in inflight.values():
+                busy.update(h['channel'] + '/' + str(h['direction']) for h in route[1:-1])
+            while todo and remaining() > 0:
+                amount = todo.pop()
+                in_policy = plugin.graph.get(payload['incoming_scid'], in_direction)
+                in_fee = forward_fee(in_policy, int(amount))
+                routes = plugin.graph.find_routes(route_out['id'], incoming_node_id,
+                                                  int(amount) + in_fee, int(amount) + maxfee * int(amount) // int(msatoshi),
+                                                  busy, 1, extra_hops=2,
+                                                  extra_delay=int(plugin.get_option('cltv-final')) + in_policy['delay'])
+                if not routes:
+                    raise RpcError("rebalance", payload, {'message': 'Could not find a route within maxfeepercent'})
+                route = [dict(route_out)] + routes[0] + [dict(route_in)]
+                setup_routing_fees(plugin, route, amount)
+                busy.update(h['channel'] + '/' + str(h['direction']) for h in routes[0])
+                partid += 1
+                started_at = time.time()
+                plugin.log("Sending part %d: %s over %d hops" % (partid, route[0]['amount_msat'], len(route)))
+                plugin.rpc.call('sendpay', {
+                    'route': route,
+                    'payment_hash': invoice['payment_hash'],
+                    'msatoshi': msatoshi,
+                    'payment_secret': invoice['payment_secret'],
+                    'partid': partid,
+                })
+                future = executor.submit(plugin.rpc.call, 'waitsendpay', {
+                    'payment_hash': invoice['payment_hash'],
+                    'timeout': max(remaining(), 1),
+                    'partid': partid,
+                })
+                inflight[future] = (partid, amount, route, started_at)
+            if not inflight:
+                raise RpcError("rebalance", payload, {'message': 'Timeout while sending parts'})
+
+            # handle parts one by one as they settle, so failed parts are
+            # sent again while the others are still pending
+            done = next(as_completed(inflight))
+            part, amount, route, started_at = inflight.pop(done)
+            try:
+                done.result()
+                fees += route[0]['amount_msat'] - amount
+                plugin.liquidity.record_success(route[1:-1])
+                plugin.history.record_attempt(invoice['payment_hash'], route, amount, started_at)
+            except RpcError as e:
+                plugin.log("Part %d failed" % part)
+                plugin.history.record_attempt(invoice['payment_hash'], route, amount, started_at, e)
+                handle_payment_error(plugin, payload, e, excludes, route)
+                todo.append(amount)
+    return fees
+
+
+def check_cancelled(payload, cancel):
+    if cancel is not None and cancel.is_set():
+        raise RpcError("rebalance", payload, {'message': 'Rebalance cancelled'})
 
 
-def cleanup(plugin, label, payload, success_msg, error=None):
+def cleanup(plugin, label, payload, result, error=None):
     try:
         plugin.rpc.delinvoice(label, 'unpaid')
     except RpcError as e:
         # race condition: waitsendpay timed out, but invoice get paid
         if 'status is paid' in e.error.get('message', ""):
-            return success_msg
+            return result
     if error is None:
         error = RpcError("rebalance", payload, {'message': 'Rebalance failed'})
     raise error
@@ -119,39 +251,30 @@ def calc_optimal_amount(out_ours, out_total, in_ours, in_total, payload):
     raise RpcError("rebalance", payload, {'message': 'rebalancing these channels will make things worse'})
 
 
-@plugin.method("rebalance")
-def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi=None,
-              maxfeepercent: float=0.5, retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000)):
-    """Rebalancing channel liquidity with circular payments.
+def execute(plugin, state, payload, cancel=None):
+    """Rebalance `payload['msatoshi']` from outgoing to incoming channel.
 
-    This tool helps to move some msatoshis between your channels.
+    Returns a result dict with the fees paid, raises an RpcError otherwise.
+    Setting the `cancel` event stops before the next payment attempt.
     """
-    if msatoshi:
-        msatoshi = Millisatoshi(msatoshi)
-    maxfeepercent = float(maxfeepercent)
-    retry_for = int(retry_for)
-    exemptfee = Millisatoshi(exemptfee)
-    payload = {
-        "outgoing_scid": outgoing_scid,
-        "incoming_scid": incoming_scid,
-        "msatoshi": msatoshi,
-        "maxfeepercent": maxfeepercent,
-        "retry_for": retry_for,
-        "exemptfee": exemptfee
-    }
-    my_node_id = plugin.rpc.getinfo().get('id')
-    outgoing_node_id = peer_from_scid(plugin, outgoing_scid, my_node_id, payload)
-    incoming_node_id = peer_from_scid(plugin, incoming_scid, my_node_id, payload)
-    get_channel(plugin, payload, outgoing_node_id, outgoing_scid, True)
-    get_channel(plugin, payload, incoming_node_id, incoming_scid, True)
-    out_ours, out_total = amounts_from_scid(plugin, outgoing_scid)
-    in_ours, in_total = amounts_from_scid(plugin, incoming_scid)
+    outgoing_scid = payload['outgoing_scid']
+    incoming_scid = payload['incoming_scid']
+    msatoshi = payload['msatoshi']
+    retry_for = payload['retry_for']
+    my_node_id = state['my_node_id']
+    outgoing_node_id = peer_from_scid(state, outgoing_scid, payload)
+    incoming_node_id = peer_from_scid(state, incoming_scid, payload)
+    get_channel(state, payload, outgoing_scid, True)
+    get_channel(state, payload, incoming_scid, True)
+    out_ours, out_total = amounts_from_scid(state, outgoing_scid)
+    in_ours, in_total = amounts_from_scid(state, incoming_scid)
     plugin.log("Outgoing node: %s, channel: %s" % (outgoing_node_id, outgoing_scid))
     plugin.log("Incoming node: %s, channel: %s" % (incoming_node_id, incoming_scid))
 
     # If amount was not given, calculate a suitable 50/50 rebalance amount
     if msatoshi is None:
         msatoshi = calc_optimal_amount(out_ours, out_total, in_ours, in_total, payload)
+        payload['msatoshi'] = msatoshi
         plugin.log("Estimating optimal amount %s" % msatoshi)
 
     # Check requested amounts are selected channels
@@ -165,63 +288,507 @@ def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi=None,
     description = "%s to %s" % (outgoing_scid, incoming_scid)
     invoice = plugin.rpc.invoice(msatoshi, label, description, retry_for + 60)
     payment_hash = invoice['payment_hash']
+    payload['payment_hash'] = payment_hash
     plugin.log("Invoice payment_hash: %s" % payment_hash)
-    success_msg = ""
+    result = None
     try:
-        excludes = []
-        # excude all own channels to prevent unwanted shortcuts [out,mid,in]
-        mychannels = plugin.rpc.listchannels(source=my_node_id)['channels']
-        for channel in mychannels:
-            excludes += [channel['short_channel_id'] + '/0', channel['short_channel_id'] + '/1']
+        # skip channels that recently failed or lack liquidity for a part
+        excludes = state['excludes'] + plugin.liquidity.excludes(int(msatoshi) // payload['parts'])
+
+        # the fee limit is a hard constraint of the route search: the incoming
+        # node takes its fee first, mid route fees must fit into the rest
+        maxfee = max(int(payload['exemptfee']), int(int(msatoshi) * payload['maxfeepercent'] / 100))
+        in_policy = plugin.graph.get(incoming_scid, route_in['direction'])
+        in_fee = forward_fee(in_policy, int(msatoshi))
+        # our own channels are the two hops around the routes found
+        extra_delay = int(plugin.get_option('cltv-final')) + in_policy['delay']
+        routes = []
+
+        if payload['parts'] > 1:
+            fees = pay_parts(plugin, payload, invoice, incoming_node_id, route_out, route_in, excludes, start_ts, cancel)
+            return {
+                "outgoing_scid": outgoing_scid,
+                "incoming_scid": incoming_scid,
+                "msatoshi": msatoshi,
+                "fee_msat": fees,
+                "parts": payload['parts'],
+                "message": "%d msat sent in %d parts to rebalance %d msat" % (msatoshi + fees, payload['parts'], msatoshi),
+            }
 
         while int(time.time()) - start_ts < retry_for:
-            r = plugin.rpc.getroute(incoming_node_id, msatoshi, riskfactor=1, cltv=9, fromid=outgoing_node_id, exclude=excludes)
-            route_mid = r['route']
-            route = [route_out] + route_mid + [route_in]
-            setup_routing_fees(plugin, route, msatoshi)
+            check_cancelled(payload, cancel)
+            routes = [r for r in routes if not any(h['channel'] + '/' + str(h['direction']) in excludes for h in r[1:-1])]
+            if not routes:
+                routes = plugin.graph.find_routes(outgoing_node_id, incoming_node_id, int(msatoshi) + in_fee,
+                                                  int(msatoshi) + maxfee, excludes, ROUTE_CANDIDATES,
+                                                  extra_hops=2, extra_delay=extra_delay)
+                if not routes:
+                    raise RpcError("rebalance", payload, {'message': 'Could not find a route within maxfeepercent'})
+                routes = [[dict(route_out)] + r + [dict(route_in)] for r in routes]
+                setup_routing_fees_batch(plugin, routes, msatoshi)
+            route = routes.pop(0)
             fees = route[0]['amount_msat'] - msatoshi
 
-            # check fee and exclude worst channel the next time
-            # NOTE: the int(msat) casts are just a workaround for outdated pylightning versions
-            if fees > exemptfee and int(fees) > int(msatoshi) * maxfeepercent / 100:
-                worst_channel_id = find_worst_channel(route)
-                if worst_channel_id is None:
-                    raise RpcError("rebalance", payload, {'message': 'Insufficient fee'})
-                excludes += [worst_channel_id + '/0', worst_channel_id + '/1']
-                continue
-
-            success_msg = "%d msat sent over %d hops to rebalance %d msat" % (msatoshi + fees, len(route), msatoshi)
+            result = {
+                "outgoing_scid": outgoing_scid,
+                "incoming_scid": incoming_scid,
+                "msatoshi": msatoshi,
+                "fee_msat": fees,
+                "hops": len(route),
+                "message": "%d msat sent over %d hops to rebalance %d msat" % (msatoshi + fees, len(route), msatoshi),
+            }
             plugin.log("Sending %s over %d hops to rebalance %s" % (msatoshi + fees, len(route), msatoshi))
             for r in route:
                 plugin.log("    - %s  %14s  %s" % (r['id'], r['channel'], r['amount_msat']))
 
+            started_at = time.time()
             try:
                 plugin.rpc.sendpay(route, payment_hash)
                 plugin.rpc.waitsendpay(payment_hash, retry_for + start_ts - int(time.time()))
-                return success_msg
+                plugin.liquidity.record_success(route[1:-1])
+                plugin.history.record_attempt(payment_hash, route, msatoshi, started_at)
+                return result
 
             except RpcError as e:
-                plugin.log("RpcError: " + str(e))
-                erring_channel = e.error.get('data', {}).get('erring_channel')
-                if erring_channel == incoming_scid:
-                    raise RpcError("rebalance", payload, {'message': 'Error with incoming channel'})
-                if erring_channel == outgoing_scid:
-                    raise RpcError("rebalance", payload, {'message': 'Error with outgoing channel'})
-                erring_direction = e.error.get('data', {}).get('erring_direction')
-                if erring_channel is not None and erring_direction is not None:
-                    excludes.append(erring_channel + '/' + str(erring_direction))
+                plugin.history.record_attempt(payment_hash, route, msatoshi, started_at, e)
+                handle_payment_error(plugin, payload, e, excludes, route)
 
     except Exception as e:
         plugin.log("Exception: " + str(e))
-        return cleanup(plugin, label, payload, success_msg, e)
-    return cleanup(plugin, label, payload, success_msg)
+        return cleanup(plugin, label, payload, result, e)
+    return cleanup(plugin, label, payload, result)
+
+
+def job_info(job):
+    info = {
+        "job_id": job['id'],
+        "status": job['status'],
+        "outgoing_scid": job['payload']['outgoing_scid'],
+        "incoming_scid": job['payload']['incoming_scid'],
+        "msatoshi": job['payload']['msatoshi'],
+        "created_at": job['created_at'],
+    }
+    for key in ['finished_at', 'result', 'error']:
+        if key in job:
+            info[key] = job[key]
+    return info
+
+
+def run_job(plugin, job, state):
+    job['status'] = 'running'
+    started_at = time.time()
+    try:
+        if state is None:
+            state = get_state(plugin)
+        job['result'] = execute(plugin, state, job['payload'], job['cancel'])
+        job['status'] = 'success'
+        result = job['result']
+        auto_track(plugin, result['outgoing_scid'], -int(result['msatoshi'] + result['fee_msat']))
+        auto_track(plugin, result['incoming_scid'], result['msatoshi'])
+        plugin.history.record_rebalance(job['payload'], job['status'], started_at, result)
+        return job['result']
+    except Exception as e:
+        job['status'] = 'cancelled' if job['cancel'].is_set() else 'failed'
+        job['error'] = e.error.get('message', str(e)) if isinstance(e, RpcError) else str(e)
+        plugin.history.record_rebalance(job['payload'], job['status'], started_at, error=job['error'])
+        raise
+    finally:
+        job['finished_at'] = int(time.time())
+
+
+def start_job(plugin, payload, state=None):
+    """Queue a rebalance on the worker pool and return its job."""
+    now = int(time.time())
+    job = {
+        'id': str(uuid.uuid4()),
+        'status': 'pending',
+        'payload': payload,
+        'created_at': now,
+        'cancel': threading.Event(),
+    }
+    # jobs are started by RPC calls and the auto_loop thread
+    with plugin.jobs_lock:
+        # forget about jobs that finished long ago
+        for job_id in [j['id'] for j in plugin.jobs.values() if j.get('finished_at', now) < now - JOB_KEEP]:
+            del plugin.jobs[job_id]
+        plugin.jobs[job['id']] = job
+    job['future'] = plugin.pool.submit(run_job, plugin, job, state)
+    return job
+
+
+@plugin.async_method("rebalance")
+def rebalance(plugin, request, outgoing_scid, incoming_scid, msatoshi: Millisatoshi=None,
+              maxfeepercent: float=0.5, retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000),
+              parts: int=1, background: bool=False):
+    """Rebalancing channel liquidity with circular payments.
+
+    This tool helps to move some msatoshis between your channels.
+    Use `parts` to split the amount into concurrent parts over different routes.
+    With `background` it returns a job_id right away, see `rebalance-status`.
+    """
+    if msatoshi:
+        msatoshi = Millisatoshi(msatoshi)
+    maxfeepercent = float(maxfeepercent)
+    retry_for = int(retry_for)
+    exemptfee = Millisatoshi(exemptfee)
+    parts = int(parts)
+    payload = {
+        "outgoing_scid": outgoing_scid,
+        "incoming_scid": incoming_scid,
+        "msatoshi": msatoshi,
+        "maxfeepercent": maxfeepercent,
+        "retry_for": retry_for,
+        "exemptfee": exemptfee,
+        "parts": parts,
+    }
+    if parts < 1:
+        raise RpcError("rebalance", payload, {'message': 'parts must be at least 1'})
+    job = start_job(plugin, payload)
+    if background:
+        request.set_result({"job_id": job['id']})
+        return
+
+    def done(future):
+        try:
+            request.set_result(future.result()['message'])
+        except Exception as e:
+            request.set_exception(e)
+    job['future'].add_done_callback(done)
+
+
+@plugin.method("rebalance-status")
+def rebalance_status(plugin, job_id=None):
+    """Show the state of one or all rebalance jobs."""
+    with plugin.jobs_lock:
+        jobs = list(plugin.jobs.values())
+    if job_id is None:
+        return {"jobs": [job_info(j) for j in jobs]}
+    job = next((j for j in jobs if j['id'] == job_id), None)
+    if job is None:
+        raise RpcError("rebalance-status", {"job_id": job_id}, {'message': 'Unknown job_id'})
+    return job_info(job)
+
+
+@plugin.method("rebalance-cancel")
+def rebalance_cancel(plugin, job_id):
+    """Cancel a rebalance job.
+
+    A running job stops before its next payment attempt, a payment already in
+    flight is not cancelled.
+    """
+    with plugin.jobs_lock:
+        job = plugin.jobs.get(job_id)
+    if job is None:
+        raise RpcError("rebalance-cancel", {"job_id": job_id}, {'message': 'Unknown job_id'})
+    job['cancel'].set()
+    if job['future'].cancel():
+        job['status'] = 'cancelled'
+        job['finished_at'] = int(time.time())
+    return job_info(job)
+
+
+def get_balances(state):
+    """Our side and capacity of every usable channel, as `scid: [ours, total]`."""
+    balances = {}
+    for scid, (peer, channel) in state['peers'].items():
+        if channel['state'] != "CHANNELD_NORMAL" or not peer['connected'] or scid not in state['funds']:
+            continue
+        ours, total = amounts_from_scid(state, scid)
+        if int(total) > 0:
+            balances[scid] = [int(ours), int(total)]
+    return balances
+
+
+def plan_rebalances(balances, payload):
+    """Pair channels above `max_percent` with channels below `min_percent`.
+
+    Channels are matched greedily, largest imbalance first. Planned amounts
+    are deducted from a copy of the balances, so a channel is never asked to
+    send or receive more than it can in total.
+    """
+    balances = {scid: list(b) for scid, b in balances.items()}
+
+    def percent(scid):
+        return 100.0 * balances[scid][0] / balances[scid][1]
+
+    pairs = []
+    while True:
+        sources = sorted([s for s in balances if percent(s) > payload['max_percent']], key=percent, reverse=True)
+        sinks = sorted([s for s in balances if percent(s) < payload['min_percent']], key=percent)
+        planned = False
+        for out_scid in sources:
+            for in_scid in sinks:
+                try:
+                    amount = calc_optimal_amount(balances[out_scid][0], balances[out_scid][1],
+                                                 balances[in_scid][0], balances[in_scid][1], payload)
+                except RpcError:
+                    continue
+                balances[out_scid][0] -= int(amount)
+                balances[in_scid][0] += int(amount)
+                pairs.append((out_scid, in_scid, amount))
+                planned = True
+                break
+            if planned:
+                break
+        if not planned:
+            return pairs
+
+
+@plugin.async_method("rebalanceall")
+def rebalanceall(plugin, request, min_percent: float=30, max_percent: float=70, maxfeepercent: float=0.5,
+                 retry_for: int=60, exemptfee: Millisatoshi=Millisatoshi(5000)):
+    """Rebalancing all channels outside of a target balance range.
+
+    Channels holding more than `max_percent` of their capacity on our side
+    are rebalanced into channels holding less than `min_percent`.
+    Each pair runs as a job that is listed by `rebalance-status`.
+    """
+    payload = {
+        "min_percent": float(min_percent),
+        "max_percent": float(max_percent),
+        "maxfeepercent": float(maxfeepercent),
+        "retry_for": int(retry_for),
+        "exemptfee": Millisatoshi(exemptfee),
+        "parts": 1,
+    }
+    if not 0 <= payload['min_percent'] <= 50 <= payload['max_percent'] <= 100:
+        raise RpcError("rebalanceall", payload, {'message': 'Percentages must satisfy 0 <= min_percent <= 50 <= max_percent <= 100'})
+
+    state = get_state(plugin)
+    pairs = plan_rebalances(get_balances(state), payload)
+    plugin.log("Planned %d rebalances" % len(pairs))
+    jobs = [start_job(plugin, dict(payload, outgoing_scid=o, incoming_scid=i, msatoshi=a), state) for o, i, a in pairs]
+
+    # wait for the jobs outside of the dispatch loop
+    def wait():
+        results = []
+        for job in jobs:
+            try:
+                results.append(job['future'].result())
+            except Exception:
+                results.append(job_info(job))
+        succeeded = [r for r in results if 'error' not in r]
+        request.set_result({
+            "rebalances": results,
+            "succeeded": len(succeeded),
+            "failed": len(results) - len(succeeded),
+            "total_msatoshi": Millisatoshi(sum(int(r['msatoshi']) for r in succeeded)),
+            "total_fee_msat": Millisatoshi(sum(int(r['fee_msat']) for r in succeeded)),
+        })
+
+    t = threading.Thread(target=wait)
+    t.daemon = True
+    t.start()
+
+
+def auto_payload(plugin):
+    return {
+        "min_percent": float(plugin.get_option('rebalance-auto-min-percent')),
+        "max_percent": float(plugin.get_option('rebalance-auto-max-percent')),
+        "maxfeepercent": float(plugin.get_option('rebalance-auto-maxfeepercent')),
+        "retry_for": 60,
+        "exemptfee": Millisatoshi(5000),
+        "parts": 1,
+    }
+
+
+def auto_needed(balances, payload):
+    """Whether there is a channel to rebalance from and one to rebalance into."""
+    percents = [100.0 * ours / total for ours, total in balances.values()]
+    return any(p > payload['max_percent'] for p in percents) and any(p < payload['min_percent'] for p in percents)
+
+
+def auto_track(plugin, scid, delta):
+    """Apply a balance change of one of our channels and wake up the scheduler if needed."""
+    auto = plugin.auto
+    if not auto['enabled']:
+        return
+    with auto['lock']:
+        balance = auto['balances'].get(scid)
+        if balance is None:
+            # a channel we do not know yet, resync on the next round
+            auto['dirty'] = True
+            return
+        balance[0] = min(max(balance[0] + int(delta), 0), balance[1])
+        needed = auto_needed(auto['balances'], auto_payload(plugin))
+    if needed:
+        auto['wakeup'].set()
+
+
+def auto_spent(plugin, now):
+    """Fees paid by automatic rebalances within the current budget window."""
+    auto = plugin.auto
+    window = int(plugin.get_option('rebalance-auto-window'))
+    with auto['lock']:
+        auto['spent'] = [(ts, fee) for ts, fee in auto['spent'] if ts > now - window]
+        return sum(fee for _, fee in auto['spent'])
+
+
+def auto_done(plugin, job):
+    pair = job['payload']['outgoing_scid'], job['payload']['incoming_scid']
+    with plugin.auto['lock']:
+        if job['status'] == 'success':
+            plugin.auto['spent'].append((job['finished_at'], int(job['result']['fee_msat'])))
+            plugin.auto['backoff'].pop(pair, None)
+        elif job['status'] == 'failed':
+            # failures cost no budget, so back off from pairs that keep failing
+            failures = plugin.auto['backoff'].get(pair, (0, 0))[0] + 1
+            wait = min(AUTO_COOLDOWN * 2 ** failures, AUTO_BACKOFF_MAX)
+            plugin.auto['backoff'][pair] = (failures, job['finished_at'] + wait)
+
+
+def auto_round(plugin):
+    """Start rebalances for channels outside the thresholds, within the fee budget."""
+    auto = plugin.auto
+    now = int(time.time())
+    if any(not job['future'].done() for job in auto['jobs']):
+        return
+    auto['jobs'] = []
+    state = None
+    if auto['dirty'] or now - auto['synced_at'] > AUTO_RESYNC:
+        state = get_state(plugin)
+        with auto['lock']:
+            auto['balances'] = get_balances(state)
+            auto['dirty'] = False
+            auto['synced_at'] = now
+    payload = auto_payload(plugin)
+    with auto['lock']:
+        balances = {scid: list(b) for scid, b in auto['balances'].items()}
+    if not auto_needed(balances, payload):
+        return
+    budget = int(Millisatoshi(plugin.get_option('rebalance-auto-budget'))) - auto_spent(plugin, now)
+    if budget <= 0:
+        plugin.log("Automatic rebalance skipped, fee budget of this window is used up")
+        return
+    if state is None:
+        state = get_state(plugin)
+        balances = get_balances(state)
+    with auto['lock']:
+        backoff = dict((pair, retry_at) for pair, (_, retry_at) in auto['backoff'].items() if retry_at > now)
+    for out_scid, in_scid, amount in plan_rebalances(balances, payload):
+        if (out_scid, in_scid) in backoff:
+            continue
+        # reserve the most a rebalance may pay, so the budget holds even if all of them succeed
+        maxfee = max(int(payload['exemptfee']), int(int(amount) * payload['maxfeepercent'] / 100))
+        if maxfee > budget:
+            continue
+        budget -= maxfee
+        job = start_job(plugin, dict(payload, outgoing_scid=out_scid, incoming_scid=in_scid, msatoshi=amount), state)
+        job['future'].add_done_callback(lambda f, job=job: auto_done(plugin, job))
+        auto['jobs'].append(job)
+    if auto['jobs']:
+        plugin.log("Automatic rebalance started %d jobs" % len(auto['jobs']))
+
+
+def auto_loop(plugin):
+    interval = int(plugin.get_option('rebalance-auto-interval'))
+    while True:
+        plugin.auto['wakeup'].wait(interval)
+        plugin.auto['wakeup'].clear()
+        try:
+            auto_round(plugin)
+        except Exception as e:
+            plugin.log("Automatic rebalance failed: %s" % e, level='warn')
+        # do not react to every single forward of a busy node
+        time.sleep(AUTO_COOLDOWN)
+
+
+@plugin.subscribe("forward_event")
+def on_forward_event(plugin, forward_event, **kwargs):
+    if forward_event.get('status') != 'settled' or 'out_channel' not in forward_event:
+        return
+    auto_track(plugin, forward_event['in_channel'],
+               Millisatoshi(forward_event.get('in_msat', forward_event.get('in_msatoshi'))))
+    auto_track(plugin, forward_event['out_channel'],
+               -int(Millisatoshi(forward_event.get('out_msat', forward_event.get('out_msatoshi')))))
+
+
+@plugin.subscribe("channel_opened")
+def on_channel_opened(plugin, channel_opened, **kwargs):
+    if plugin.auto['enabled']:
+        plugin.auto['dirty'] = True
+        plugin.auto['wakeup'].set()
+
+
+@plugin.method("rebalance-auto")
+def rebalance_auto(plugin):
+    """Show the state of automatic rebalancing."""
+    auto = plugin.auto
+    now = int(time.time())
+    payload = auto_payload(plugin)
+    with auto['lock']:
+        balances = dict(auto['balances'])
+        backoff = [{"outgoing_scid": o, "incoming_scid": i, "failures": failures, "retry_at": retry_at}
+                   for (o, i), (failures, retry_at) in auto['backoff'].items() if retry_at > now]
+    return {
+        "enabled": auto['enabled'],
+        "min_percent": payload['min_percent'],
+        "max_percent": payload['max_percent'],
+        "budget_msat": Millisatoshi(plugin.get_option('rebalance-auto-budget')),
+        "spent_msat": Millisatoshi(auto_spent(plugin, now)),
+        "window": int(plugin.get_option('rebalance-auto-window')),
+        "channels_below": len([b for b in balances.values() if 100.0 * b[0] / b[1] < payload['min_percent']]),
+        "channels_above": len([b for b in balances.values() if 100.0 * b[0] / b[1] > payload['max_percent']]),
+        "jobs": [job_info(j) for j in auto['jobs']],
+        "backoff": backoff,
+    }
+
+
+@plugin.method("rebalance-history")
+def rebalance_history(plugin, start: int=None, end: int=None, scid: str=None, days: float=30, limit: int=100):
+    """Show past rebalances and what they cost per channel.
+
+    Lists rebalances started between `start` and `end` (unix timestamps,
+    default: the last `days` days), optionally only those of channel `scid`,
+    and their totals per channel as outgoing and incoming side.
+    """
+    end = int(end) if end is not None else None
+    start = int(start) if start is not None else int(time.time() - float(days) * 86400)
+    return {
+        "channels": plugin.history.channels(start, end, scid),
+        "rebalances": plugin.history.rebalances(start, end, scid, int(limit)),
+    }
 
 
 @plugin.init()
 def init(options, configuration, plugin):
     plugin.options['cltv-final']['value'] = plugin.rpc.listconfigs().get('cltv-final')
+    plugin.graph = ChannelGraph(plugin.rpc, int(options['rebalance-gossip-age']))
+    plugin.liquidity = LiquidityStore(os.path.join(configuration['lightning-dir'], 'liquidity.sqlite3'))
+    plugin.liquidity.prune()
+    plugin.history = HistoryStore(os.path.join(configuration['lightning-dir'], 'rebalance.sqlite3'))
+    plugin.pool = ThreadPoolExecutor(max_workers=int(options['rebalance-parallel']))
+    plugin.jobs = {}
+    plugin.jobs_lock = threading.Lock()
+    plugin.auto = {
+        'enabled': str(options['rebalance-auto']).lower() in ('true', '1', 'yes'),
+        'lock': threading.Lock(),
+        'wakeup': threading.Event(),
+        'balances': {},
+        'dirty': True,
+        'synced_at': 0,
+        'spent': [],
+        'jobs': [],
+        'backoff': {},  # (outgoing_scid, incoming_scid) -> (failures, retry_at)
+    }
+    if plugin.auto['enabled']:
+        t = threading.Thread(target=auto_loop, args=(plugin,))
+        t.daemon = True
+        t.start()
+        plugin.auto['wakeup'].set()
     plugin.log("Plugin rebalance.py initialized")
 
 
 plugin.add_option('cltv-final', 10, 'Number of blocks for final CheckLockTimeVerify expiry')
-plugin.run()
+plugin.add_option('rebalance-gossip-age', 600, 'Seconds after which the cached channel policies are fetched again')
+plugin.add_option('rebalance-parallel', 4, 'Maximum number of rebalances that run at the same time')
+plugin.add_option('rebalance-auto', 'false', 'Rebalance channels automatically when they leave the balance thresholds')
+plugin.add_option('rebalance-auto-min-percent', 30, 'Automatic rebalance fills channels with less than this percentage on our side')
+plugin.add_option('rebalance-auto-max-percent', 70, 'Automatic rebalance drains channels with more than this percentage on our side')
+plugin.add_option('rebalance-auto-maxfeepercent', 0.5, 'Fee limit of each automatic rebalance in percent of its amount')
+plugin.add_option('rebalance-auto-budget', '10000sat', 'Maximum fees automatic rebalances pay within rebalance-auto-window')
+plugin.add_option('rebalance-auto-window', 86400, 'Seconds of the rebalance-auto-budget window')
+plugin.add_option('rebalance-auto-interval', 600, 'Seconds between automatic rebalance checks when no forward wakes them up')
+
+if __name__ == "__main__":
+    plugin.run()
@@ -0,0 +1,80 @@
+from graph import ChannelGraph
+
+
+class FakeRpc(object):
+
+    def __init__(self, channels):
+        self.channels = channels
+
+    def listchannels(self, scid=None):
+        return {'channels': [c for c in self.channels if scid is None or c['short_channel_id'] == scid]}
+
+
+def channel(scid, source, destination, base=0, ppm=0, delay=6):
+    return {
+        'short_channel_id': scid,
+        'channel_flags': 0 if source < destination else 1,
+        'source': source,
+        'destination': destination,
+        'active': True,
+        'satoshis': 10**6,
+        'base_fee_millisatoshi': base,
+        'fee_per_millionth': ppm,
+        'delay': delay,
+    }
+
+
+def diamond():
+    # three two hop paths from S to T, each one more expensive than the last
+    return [
+        channel('1x1x0', 'S', 'A', base=1000), channel('2x1x0', 'A', 'T', base=1000),
+        channel('3x1x0', 'S', 'B', base=2000), channel('4x1x0', 'B', 'T', base=2000),
+        channel('5x1x0', 'S', 'C', base=3000), channel('6x1x0', 'C', 'T', base=3000),
+    ]
+
+
+def scids(routes):
+    return [[h['channel'] for h in r] for r in routes]
+
+
+def test_find_routes_cheapest_first():
+    graph = ChannelGraph(FakeRpc(diamond()))
+    routes = graph.find_routes('S', 'T', 10**6, 2 * 10**6, count=5)
+    assert scids(routes) == [['1x1x0', '2x1x0'], ['3x1x0', '4x1x0'], ['5x1x0', '6x1x0']]
+    assert routes[0][0] == {'id': 'A', 'channel': '1x1x0', 'direction': 1}
+
+
+def test_find_routes_max_amount_and_excludes():
+    graph = ChannelGraph(FakeRpc(diamond()))
+    assert scids(graph.find_routes('S', 'T', 10**6, 10**6 + 4000, count=5)) == [['1x1x0', '2x1x0'], ['3x1x0', '4x1x0']]
+    assert scids(graph.find_routes('S', 'T', 10**6, 2 * 10**6, excludes=['2x1x0/0'], count=5)) == \
+        [['3x1x0', '4x1x0'], ['5x1x0', '6x1x0']]
+
+
+def test_find_routes_limits():
+    # the cheap path is long and slow, the expensive one short and fast
+    channels = [channel('%dx1x0' % i, 'N%d' % i, 'N%d' % (i + 1), delay=40) for i in range(5)]
+    channels.append(channel('9x1x0', 'N0', 'N5', base=5000, delay=10))
+    graph = ChannelGraph(FakeRpc(channels), max_hops=7, max_delay=250)
+    assert len(graph.find_routes('N0', 'N5', 10**6, 2 * 10**6)[0]) == 5
+    # three extra hops leave room for four hops only
+    assert len(graph.find_routes('N0', 'N5', 10**6, 2 * 10**6, extra_hops=3)[0]) == 1
+    assert len(graph.find_routes('N0', 'N5', 10**6, 2 * 10**6, extra_delay=60)[0]) == 1
+
+
+def test_invalidate_refetches_channel():
+    channels = diamond()
+    graph = ChannelGraph(FakeRpc(channels))
+    assert scids(graph.find_routes('S', 'T', 10**6, 2 * 10**6)) == [['1x1x0', '2x1x0']]
+    channels[1]['base_fee_millisatoshi'] = 10000
+    graph.invalidate('2x1x0')
+    assert graph.get('2x1x0', 0)['base'] == 10000
+    assert scids(graph.find_routes('S', 'T', 10**6, 2 * 10**6)) == [['3x1x0', '4x1x0']]
+    # a busy channel stays in the graph with its fresh policy
+    channels[1]['base_fee_millisatoshi'] = 0
+    graph.invalidate('2x1x0')
+    assert scids(graph.find_routes('S', 'T', 10**6, 2 * 10**6)) == [['1x1x0', '2x1x0']]
+    # a closed one leaves it
+    del channels[1]
+    graph.invalidate('2x1x0')
+    assert scids(graph.find_routes('S', 'T', 10**6, 2 * 10**6)) == [['3x1x0', '4x1x0']]
@@ -0,0 +1,35 @@
+from rebalance import plan_rebalances
+
+PAYLOAD = {'min_percent': 30, 'max_percent': 70, 'maxfeepercent': 0.5, 'exemptfee': 5000}
+
+
+def amounts(pairs):
+    return [(o, i, int(a)) for o, i, a in pairs]
+
+
+def test_pairs_one_source_with_one_sink():
+    assert amounts(plan_rebalances({'1x1x0': [90, 100], '2x1x0': [10, 100]}, PAYLOAD)) == [('1x1x0', '2x1x0', 40)]
+
+
+def test_nothing_to_do_within_thresholds():
+    assert plan_rebalances({'1x1x0': [65, 100], '2x1x0': [35, 100]}, PAYLOAD) == []
+    # a source without any sink is left alone
+    assert plan_rebalances({'1x1x0': [90, 100], '2x1x0': [50, 100]}, PAYLOAD) == []
+
+
+def test_largest_imbalance_first():
+    balances = {'1x1x0': [90, 100], '2x1x0': [10, 100], '3x1x0': [80, 100], '4x1x0': [25, 100]}
+    assert amounts(plan_rebalances(balances, PAYLOAD)) == [('1x1x0', '2x1x0', 40), ('3x1x0', '4x1x0', 25)]
+    # the balances of the caller are not changed
+    assert balances['1x1x0'] == [90, 100]
+
+
+def test_amounts_are_deducted_between_pairs():
+    # one big source serves two small sinks, each up to half of its capacity
+    balances = {'1x1x0': [900, 1000], '2x1x0': [10, 100], '3x1x0': [0, 100]}
+    assert amounts(plan_rebalances(balances, PAYLOAD)) == [('1x1x0', '3x1x0', 50), ('1x1x0', '2x1x0', 40)]
+
+
+def test_amount_limited_by_the_smaller_channel():
+    # the sink could take 500, the source only has 40 above its half
+    assert amounts(plan_rebalances({'1x1x0': [90, 100], '2x1x0': [0, 1000]}, PAYLOAD)) == [('1x1x0', '2x1x0', 40)]
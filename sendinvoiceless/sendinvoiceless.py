@@ -1,27 +1,32 @@
 #!/usr/bin/env python3
+from fees import policy_arrays, route_amounts
+from liquidity import LiquidityStore
 from pyln.client import Plugin, Millisatoshi, RpcError
 from datetime import datetime
+import numpy as np
+import os
 import time
 import uuid
 
 plugin = Plugin()
 
 def setup_routing_fees(plugin, route, msatoshi, payload):
-    delay = int(plugin.get_option('cltv-final'))
-    for r in reversed(route):
-        r['msatoshi'] = msatoshi.millisatoshis
-        r['amount_msat'] = msatoshi
-        r['delay'] = delay
+    policies = {}
+    for r in route:
         channels = plugin.rpc.listchannels(r['channel'])
         ch = next(c for c in channels.get('channels') if c['destination'] == r['id'])
-        fee = Millisatoshi(ch['base_fee_millisatoshi'])
-        # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
-        fee += (msatoshi * ch['fee_per_millionth'] + 10**6 - 1) // 10**6       # integer math trick to round up
-        if ch['source'] == payload['nodeid']:
-            fee += payload['msatoshi']
-        msatoshi += fee
-        delay += ch['delay']
         r['direction'] = int(ch['channel_flags']) % 2
+        policies[r['channel'], r['id']] = {'base': ch['base_fee_millisatoshi'], 'ppm': ch['fee_per_millionth'], 'delay': ch['delay'],
+                                  'source': ch['source']}
+    base, ppm, delay = policy_arrays([route], lambda r: policies[r['channel'], r['id']])
+    # the node we send to takes its amount on top of the fee of its channel
+    extra = np.array([[int(payload['msatoshi']) if policies[r['channel'], r['id']]['source'] == payload['nodeid'] else 0
+                       for r in route]], dtype=np.int64)
+    amounts, delays = route_amounts(base, ppm, delay, int(msatoshi), int(plugin.get_option('cltv-final')), extra)
+    for i, r in enumerate(route):
+        r['msatoshi'] = int(amounts[0, i])
+        r['amount_msat'] = Millisatoshi(r['msatoshi'])
+        r['delay'] = int(delays[0, i])
 
 
 def find_worst_channel(route, nodeid):
@@ -75,7 +80,8 @@ def sendinvoiceless(plugin, nodeid, msatoshi: Millisatoshi, maxfeepercent: float
     plugin.log("Invoice payment_hash: %s" % payment_hash)
     success_msg = ""
     try:
-        excludes = []
+        # skip channels that recently failed or lack liquidity for this amount
+        excludes = plugin.liquidity.excludes(msatoshi)
         start_ts = int(time.time())
         while int(time.time()) - start_ts < retry_for:
             forth = plugin.rpc.getroute(nodeid, msatoshi + change, riskfactor=10, exclude=excludes)
@@ -101,6 +107,7 @@ def sendinvoiceless(plugin, nodeid, msatoshi: Millisatoshi, maxfeepercent: float
             try:
                 plugin.rpc.sendpay(route, payment_hash)
                 plugin.rpc.waitsendpay(payment_hash, retry_for + start_ts - int(time.time()))
+                plugin.liquidity.record_success(route[1:-1])
                 return success_msg
 
             except RpcError as e:
@@ -109,6 +116,10 @@ def sendinvoiceless(plugin, nodeid, msatoshi: Millisatoshi, maxfeepercent: float
                 erring_direction = e.error.get('data', {}).get('erring_direction')
                 if erring_channel is not None and erring_direction is not None:
                     excludes.append(erring_channel + '/' + str(erring_direction))
+                    # remember the failure for later runs and the other plugins
+                    hop = next((h for h in route[1:-1] if h['channel'] == erring_channel), None)
+                    if hop is not None:
+                        plugin.liquidity.record_failure(excludes[-1], hop['msatoshi'], e.error['data'].get('failcode'))
 
     except Exception as e:
         plugin.log("Exception: " + str(e))
@@ -176,6 +187,8 @@ def init(options, configuration, plugin):
     plugin.options['cltv-final']['value'] = plugin.rpc.listconfigs().get('cltv-final')
     plugin.options['fee-base']['value'] = plugin.rpc.listconfigs().get('fee-base')
     plugin.options['fee-per-satoshi']['value'] = plugin.rpc.listconfigs().get('fee-per-satoshi')
+    plugin.liquidity = LiquidityStore(os.path.join(configuration['lightning-dir'], 'liquidity.sqlite3'))
+    plugin.liquidity.prune()
     plugin.log("Plugin sendinvoiceless.py initialized")
 
 